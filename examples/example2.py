@@ -8,10 +8,11 @@ logging.basicConfig(level=logging.INFO)
 
 bus = SimpleBus("simple_bus")
 main_memory = SimpleMemory("simple_memory", 100, 'whatever')
-slave = SimpleMemory("slave_memory", 100, 'whatever', 4)
+slave = SimpleMemory("slave_memory", 100, 'whatever')
 
-main_memory.attach_slave(slave, 100, 200, 0)
-bus.attach_slave(main_memory, 0, 200, 0)
+# main_memory serves [0, 100K) itself, anything above is forwarded to the slave.
+main_memory.attach_slave(slave, 100 * 1024, 200 * 1024, 0)
+bus.attach_slave(main_memory, 0, 200 * 1024, 0)
 
 mmu = SimpleMMU("simple_mmu")
 mmu.attach_slave(bus, 0, 1000, 0)
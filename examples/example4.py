@@ -0,0 +1,72 @@
+import struct
+import logging
+
+from controllers.memory import SimpleMemory
+from controllers.timer import SimpleTimer, TIMER_IRQ
+from buses.simple_bus import SimpleBus
+from processors.arm.cortext_a9 import ARMCortexA9
+from soc.checkpoints import CheckpointRing
+from soc import snapshot
+
+# Rewinds a guest interrupted by a live host timer and checks that every goto() lands on the
+# state the guest had when it first got there.
+
+logging.basicConfig(level=logging.WARNING)
+
+RAM = 0x40300000
+
+#   mov r1, #0
+# loop:
+#   add r1, r1, #1
+#   str r1, [r0, #16]
+#   b loop
+# ...
+# irq (vectors at RAM + 0x100):
+#   add r3, r3, #1
+#   b loop
+code = struct.pack('<4I', 0xE3A01000, 0xE2811001, 0xE5801010, 0xEAFFFFFC)
+code += '\0' * (0x118 - len(code)) + struct.pack('<2I', 0xE2833001, 0xEAFFFFB8)
+
+bus = SimpleBus("simple_bus")
+ram = SimpleMemory("simple_ram", 4, 'little')
+bus.attach_slave(ram, RAM, RAM + 4 * 1024)
+
+cpu = ARMCortexA9("cpu0", bus)
+for offset in range(0, len(code), 4):
+    cpu.bus_port.write(RAM + offset, struct.unpack_from('<I', code, offset)[0])
+cpu.register_write(0, RAM + 0x200)
+cpu._SCTLR().value &= ~cpu.SCTLR_V
+cpu._VBAR().value = RAM + 0x100
+cpu.set_ip(RAM)
+
+# No interrupt controller to acknowledge the irq, the handler entry does.
+def acknowledge(cpu, pc, vector):
+    cpu.received_interrupts[cpu.IRQ_IRQ] = False
+cpu.register_plugin('exception', acknowledge)
+
+timer = SimpleTimer("simple_timer")
+timer.set_high(300)
+cpu.attach_to(timer, TIMER_IRQ, cpu.IRQ_IRQ)
+
+ring = CheckpointRing(cpu, {'ram': ram}, interval=2000, capacity=64)
+ring.attach()
+
+def state():
+    return snapshot.capture_state({'cpu0': cpu}, {}), str(ram.image())
+
+targets = [3000, 7777, 12345, 19999]
+seen = {}
+for target in targets:
+    cpu.schedule(target, lambda cpu, target=target: seen.__setitem__(target, state()))
+
+cpu.schedule(100, lambda cpu: timer.start())
+while cpu.icount < 25000:
+    cpu.execute()
+timer.stop()
+# Delivers what the timer posted last.
+cpu._run_events()
+
+print "%d interrupts logged" % len(ring.interrupts)
+for target in reversed(targets):
+    ring.goto(target)
+    print "goto(%d): %s" % (target, "same" if state() == seen[target] else "DIFFERENT")
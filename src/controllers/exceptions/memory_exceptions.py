@@ -9,6 +9,21 @@ class OutOfRangeError(Exception):
         self.address    = address
         self.bank       = bank
         
+class OverlappingRegionError(Exception):
+    def __init__(self, start, end, other_start, other_end, bank=0):
+        Exception.__init__(self)
+        self.start      = start
+        self.end        = end
+        self.other_start = other_start
+        self.other_end  = other_end
+        self.bank       = bank
+        
+class UnsupportedAccessSizeError(Exception):
+    def __init__(self, address, size):
+        Exception.__init__(self)
+        self.address    = address
+        self.size       = size
+        
 class ReadOnlyMemory(Exception):
     def __init__(self, address):
         self.address = address
\ No newline at end of file
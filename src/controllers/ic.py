@@ -18,6 +18,20 @@ class SimpleInterruptController(AbstractInterruptConsumer, AbstractInterruptProd
         
         self.current_priority = 9 # We've 10 levels from (0 =>> 9)    
     
+    def get_state(self):
+        return {
+                'fiq_producers'     : list(self.fiq_producers),
+                'all_masked'        : self.all_masked,
+                'masked_irqs'       : list(self.masked_irqs),
+                'current_priority'  : self.current_priority
+               }
+    
+    def set_state(self, state):
+        self.fiq_producers = list(state['fiq_producers'])
+        self.all_masked = state['all_masked']
+        self.masked_irqs = list(state['masked_irqs'])
+        self.current_priority = state['current_priority']
+    
     def enable_all(self):
         self.all_masked = False
     
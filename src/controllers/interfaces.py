@@ -1,7 +1,12 @@
 import logging
+from ctypes import c_uint32
 from controllers.exceptions.memory_exceptions import BankNotFoundError,\
-    OutOfRangeError
-import global_env
+    OutOfRangeError, OverlappingRegionError, UnsupportedAccessSizeError
+from utils.intervals import IntervalIndex
+from instrumentation.trace import tracer, PROXY_READ, PROXY_WRITE
+
+# Access size in bytes => mask of the value.
+ACCESS_SIZE_MASKS = {1: 0xFF, 2: 0xFFFF, 4: 0xFFFFFFFF}
 
 class AbstractInterruptProducer(object):
     def __init__(self, name):
@@ -68,133 +73,368 @@ class AbstractInterruptConsumer(object):
         self.logger.info("Interrupt number (%s) was triggered", returned_irq)
 
 class AbstractBankedAddressableObject(object):
+    # Whether parents may look through this object and decode straight to its leaves.
+    # Objects that translate addresses on the fly (proxies) must stay opaque.
+    flattenable = True
+    
+    # Values on the bus are plain ints masked to 32 bits. Old device models whose _read
+    # returns, and _write expects, a c_uint32 set this and get wrapped by the bus.
+    ctypes_protocol = False
+    
+    # Access sizes (in bytes) our _read/_write serve natively. Objects declaring more than
+    # just word accesses get the size as an extra argument. Narrower reads on word-only
+    # objects are served by the bus out of the containing word, narrower writes are refused.
+    access_sizes = (4,)
+    
     def __init__(self, wordsize= 4, multi_targets=False):
+        # {bank : [(start, end, offset, slave), ...]}
         self.slaves = {}
+        # {bank : [(start, end), ...]}
         self.regions_map = {}
         self.word_size = wordsize
+        
+        # Same content as above, kept sorted per bank for bisect lookups.
+        self._slaves_index = {}
+        self._regions_index = {}
+        
+        # Objects we're attached to as a slave, they cache our layout in their flat maps.
+        self._parents = []
+        # {(bank, implicit) : IntervalIndex of (start, end, target, delta, leaf, read_fn, write_fn)}
+        self._flat_maps = {}
+        # Ports handed out to masters, they hold on to one of our flat maps.
+        self._ports = []
+    
+    def _invalidate_flat_maps(self):
+        self._flat_maps = {}
+        for port in self._ports:
+            port.invalidate()
+        for parent in self._parents:
+            parent._invalidate_flat_maps()
+    
+    def _check_overlap(self, start, end, bank):
+        for index in (self._regions_index.get(bank, None), self._slaves_index.get(bank, None)):
+            if index is None:
+                continue
+            
+            entry = index.find_overlap(start, end)
+            if entry is not None:
+                raise OverlappingRegionError(start, end, entry[0], entry[1], bank)
     
     def attach_slave(self, addressable_object, start_addr, end_addr, offset = 0, bank="default"):
+        self._check_overlap(start_addr, end_addr, bank)
+        
         bucket = self.slaves.get(bank, None)
         if not bucket:
             self.slaves[bank] = []
-            
-        self.slaves[bank].append((start_addr, end_addr, offset, addressable_object))
+            self._slaves_index[bank] = IntervalIndex()
+        
+        entry = (start_addr, end_addr, offset, addressable_object)
+        self.slaves[bank].append(entry)
+        self._slaves_index[bank].insert(entry)
+        
+        if isinstance(addressable_object, AbstractBankedAddressableObject):
+            addressable_object._parents.append(self)
+        self._invalidate_flat_maps()
              
     def _serve_region(self, start, end, bank="default"):
+        if start > end:
+            start, end = end, start
+        
+        self._check_overlap(start, end, bank)
+        
         bucket = self.regions_map.get(bank, None)
         if not bucket:
             self.regions_map[bank] = []
-            
-        if start > end:
-            start, end = end, start
+            self._regions_index[bank] = IntervalIndex()
 
         self.regions_map[bank].append((start, end))
+        self._regions_index[bank].insert((start, end))
+        self._invalidate_flat_maps()
     
-    def read(self, address, bank="default", implicit=False):
-        bucket = self.regions_map.get(bank, None)
-        if not bucket and not implicit:
-            raise BankNotFoundError(bank)
-        elif not bucket and implicit:
-            bucket = self.regions_map.get("default", None)
-
-        if bucket:
-            for start, end in bucket:
-                if start <= address < end:
-                    return self._read(address)
+    def _leaf_accessors(self):
+        '''
+            Returns the (read_fn(address, size), write_fn(address, value, size)) pair the bus
+            uses to reach our own regions.
+        '''
+        sizes = self.access_sizes
+        if not self.ctypes_protocol and set(sizes) == set(ACCESS_SIZE_MASKS):
+            return self._read, self._write
+        
+        if self.ctypes_protocol:
+            read = lambda address, size: self._read(address).value
+            write = lambda address, value, size: self._write(address, c_uint32(value))
+        elif len(sizes) == 1:
+            read = lambda address, size: self._read(address)
+            write = lambda address, value, size: self._write(address, value)
+        else:
+            read, write = self._read, self._write
+        
+        def read_fn(address, size=4):
+            if size in sizes:
+                return read(address, size)
             
-        bucket = self.slaves.get(bank, None)
-        if not bucket and not implicit:
-            raise BankNotFoundError(bank)
-        elif not bucket and implicit:
-            bucket = self.slaves.get("default", None)
-            if not bucket:
-                raise BankNotFoundError
+            # Read the containing word and pick the bytes out of it (little endian).
+            shift = (address & 3) << 3
+            return (read(address & ~3, 4) >> shift) & ACCESS_SIZE_MASKS[size]
+        
+        def write_fn(address, value, size=4):
+            if size not in sizes:
+                raise UnsupportedAccessSizeError(address, size)
+            write(address, value, size)
+        
+        return read_fn, write_fn
+    
+    def _opaque_accessors(self, bank, implicit):
+        '''
+            Returns the (read_fn, write_fn) pair used to forward an access to us as a whole.
+        '''
+        def read_fn(address, size=4):
+            return self.read(address, bank, implicit, size)
+        
+        def write_fn(address, value, size=4):
+            self.write(address, value, bank, implicit, size)
+        
+        return read_fn, write_fn
+    
+    def _compile_flat_map(self, bank, implicit):
+        '''
+            Flattens this object and every flattenable slave below it into one table that maps
+            an address directly to the object serving it, following the same lookup rules as
+            _walk_read/_walk_write. Accesses the table can't answer fall back to the walk,
+            which raises the appropriate error.
+        '''
+        flat = IntervalIndex()
+        
+        index = self._regions_index.get(bank, None)
+        if index is None and implicit:
+            index = self._regions_index.get("default", None)
+        
+        if index is not None:
+            read_fn, write_fn = self._leaf_accessors()
+            for start, end in index:
+                flat.insert((start, end, self, 0, True, read_fn, write_fn))
+        
+        index = self._slaves_index.get(bank, None)
+        if index is None and implicit:
+            index = self._slaves_index.get("default", None)
+        
+        if index is None:
+            return flat
+        
+        for start, end, offset, slave in index:
+            shift = start - offset
+            if isinstance(slave, AbstractBankedAddressableObject) and slave.flattenable:
+                entries = []
+                for child_start, child_end, target, delta, leaf, read_fn, write_fn in slave._flat_map(bank, implicit):
+                    child_start = max(child_start + shift, start)
+                    child_end = min(child_end + shift, end)
+                    if child_start < child_end:
+                        entries.append((child_start, child_end, target, delta - shift, leaf, read_fn, write_fn))
+            else:
+                read_fn, write_fn = slave._opaque_accessors(bank, implicit)
+                entries = [(start, end, slave, -shift, False, read_fn, write_fn)]
+            
+            for entry_start, entry_end, target, delta, leaf, read_fn, write_fn in entries:
+                # Served regions take precedence over slaves, same as in the walk.
+                for gap_start, gap_end in flat.uncovered(entry_start, entry_end):
+                    flat.insert((gap_start, gap_end, target, delta, leaf, read_fn, write_fn))
+        
+        return flat
+    
+    def _flat_map(self, bank="default", implicit=False):
+        flat = self._flat_maps.get((bank, implicit), None)
+        if flat is None:
+            flat = self._flat_maps[(bank, implicit)] = self._compile_flat_map(bank, implicit)
+        return flat
+    
+    def resolve_target(self, address, bank="default", implicit=False):
+        '''
+            Returns (target, local_address, leaf). If leaf is True the target serves the access
+            itself through _read/_write, otherwise it's an opaque object (a proxy) to forward
+            the access to through read/write.
+        '''
+        entry = self._flat_map(bank, implicit).find(address)
+        if entry is None:
+            raise OutOfRangeError(address, bank)
+        
+        return entry[2], address + entry[3], entry[4]
+    
+    def get_port(self, bank="default", implicit=False):
+        '''
+            Returns a port bound to one bank, to be kept by a master (a cpu core, the debugger,
+            a DMA engine ...) and used for all its accesses instead of read/write.
+        '''
+        port = BusPort(self, bank, implicit)
+        self._ports.append(port)
+        return port
+    
+    def read(self, address, bank="default", implicit=False, size=4):
+        flat = self._flat_maps.get((bank, implicit), None)
+        if flat is None:
+            flat = self._flat_map(bank, implicit)
+        
+        entry = flat.find(address)
+        if entry is not None:
+            return entry[5](address + entry[3], size)
+        
+        return self._walk_read(address, bank, implicit, size)
+    
+    def _walk_read(self, address, bank="default", implicit=False, size=4):
+        index = self._regions_index.get(bank, None)
+        if index is None:
+            if not implicit:
+                raise BankNotFoundError(bank)
+            index = self._regions_index.get("default", None)
+
+        if index is not None and index.find(address) is not None:
+            return self._leaf_accessors()[0](address, size)
             
-        for start, end, offset, slave in bucket:
-            if start <= address < end:
-                return slave.read(address - start + offset, bank, implicit)
+        index = self._slaves_index.get(bank, None)
+        if index is None:
+            if not implicit:
+                raise BankNotFoundError(bank)
+            index = self._slaves_index.get("default", None)
+            if index is None:
+                raise BankNotFoundError(bank)
+        
+        entry = index.find(address)
+        if entry is not None:
+            start, _, offset, slave = entry
+            return slave.read(address - start + offset, bank, implicit, size)
         
         raise OutOfRangeError(address, bank)
 
     #override
-    def _read(self, address, bank="default"):
-        self.logger.info("Reading from address (%s) through bank (%s)", address, bank)
+    def _read(self, address):
+        self.logger.info("Reading from address (%s)", address)
     
-    def write(self, address, value, bank="default", implicit=False):
-        bucket = self.regions_map.get(bank, None)
-        if not bucket and not implicit:
-            raise BankNotFoundError(bank)
-        elif not bucket and implicit:
-            bucket = self.regions_map.get("default", None)
+    def write(self, address, value, bank="default", implicit=False, size=4):
+        flat = self._flat_maps.get((bank, implicit), None)
+        if flat is None:
+            flat = self._flat_map(bank, implicit)
+        
+        entry = flat.find(address)
+        if entry is not None:
+            entry[6](address + entry[3], value, size)
+            return
+        
+        self._walk_write(address, value, bank, implicit, size)
+    
+    def _walk_write(self, address, value, bank="default", implicit=False, size=4):
+        index = self._regions_index.get(bank, None)
+        if index is None:
+            if not implicit:
+                raise BankNotFoundError(bank)
+            index = self._regions_index.get("default", None)
 
-        if bucket:
-            for start, end in bucket:
-                if start <= address < end:
-                    self._write(address, value)
-                    return
+        if index is not None and index.find(address) is not None:
+            self._leaf_accessors()[1](address, value, size)
+            return
         
-        bucket = self.slaves.get(bank, None)
-        if not bucket and not implicit:
-            raise BankNotFoundError(bank)
-        elif not bucket and implicit:
-            bucket = self.slaves.get("default", None)
-            if not bucket:
-                raise BankNotFoundError
-                
-        for start, end, offset, slave in bucket:
-            if start <= address < end:
-                slave.write(address - start + offset, value, bank, implicit)
-                return
+        index = self._slaves_index.get(bank, None)
+        if index is None:
+            if not implicit:
+                raise BankNotFoundError(bank)
+            index = self._slaves_index.get("default", None)
+            if index is None:
+                raise BankNotFoundError(bank)
+        
+        entry = index.find(address)
+        if entry is not None:
+            start, _, offset, slave = entry
+            slave.write(address - start + offset, value, bank, implicit, size)
+            return
         
         raise OutOfRangeError(address, bank)
         
     #override
-    def _write(self, address, value, bank="default" ):
-        self.logger.info("Writing value (%s) to address (%s) through bank (%s)", value, address, bank)
+    def _write(self, address, value):
+        self.logger.info("Writing value (%s) to address (%s)", value, address)
     
         
 class AbstractImplicitBankedAddressableObject(AbstractBankedAddressableObject):
     def __init__(self, wordsize= 4, multi_targets=False):
-        self.slaves = {}
-        self.regions_map = {}
-        self.word_size = wordsize
+        AbstractBankedAddressableObject.__init__(self, wordsize, multi_targets)
         
-    def read(self, address):
-        bank = global_env.THREAD_ENV.engine_id
-        return super(AbstractImplicitBankedAddressableObject, self).read(address, bank, True)
+    def get_port(self, bank, implicit=True):
+        return super(AbstractImplicitBankedAddressableObject, self).get_port(bank, implicit)
+    
+    # Masters go through their port, direct accesses name their bank and fall back to the
+    # default one. Same signature as our parent so we can still be reached through it.
+    def read(self, address, bank="default", implicit=True, size=4):
+        return super(AbstractImplicitBankedAddressableObject, self).read(address, bank, implicit, size)
         
-    def write(self, address, value):
-        bank = global_env.THREAD_ENV.engine_id
-        super(AbstractImplicitBankedAddressableObject, self).write(address, value, bank, True)
+    def write(self, address, value, bank="default", implicit=True, size=4):
+        super(AbstractImplicitBankedAddressableObject, self).write(address, value, bank, implicit, size)
+
+
+class BusPort(object):
+    '''
+        A master's connection to an addressable object. The bank is fixed when the port is
+        created and the decode table is looked up once and kept until the layout changes,
+        so accesses don't depend on which thread issues them.
+    '''
+    def __init__(self, target, bank="default", implicit=False):
+        self.target = target
+        self.bank = bank
+        self.implicit = implicit
+        self._flat = None
+    
+    def invalidate(self):
+        self._flat = None
+    
+    def read(self, address, size=4):
+        flat = self._flat
+        if flat is None:
+            flat = self._flat = self.target._flat_map(self.bank, self.implicit)
+        
+        entry = flat.find(address)
+        if entry is not None:
+            return entry[5](address + entry[3], size)
+        
+        return self.target._walk_read(address, self.bank, self.implicit, size)
+    
+    def write(self, address, value, size=4):
+        flat = self._flat
+        if flat is None:
+            flat = self._flat = self.target._flat_map(self.bank, self.implicit)
+        
+        entry = flat.find(address)
+        if entry is not None:
+            entry[6](address + entry[3], value, size)
+            return
+        
+        self.target._walk_write(address, value, self.bank, self.implicit, size)
 
 
 class AbstractBankedAddressableObjectProxy(AbstractBankedAddressableObject):
+    flattenable = False
+    
     def __init__(self, wordsize = 4, multi_targets=False):
         AbstractBankedAddressableObject.__init__(self, wordsize, multi_targets)
         self.translation_enabled = False
     
-    def read(self, vaddress, bank=0):
+    def read(self, vaddress, bank="default", implicit=False, size=4):
         address = self.resolve_address(vaddress, bank)
-        value = super(AbstractBankedAddressableObjectProxy, self).read(address)
-        self.logger.info("Reading value (%s) from (vaddress=%s, address=%s) through bank (%s)", value, vaddress, address, bank)
+        value = super(AbstractBankedAddressableObjectProxy, self).read(address, bank, implicit, size)
+        if tracer.proxy:
+            tracer.record(PROXY_READ, vaddress, value)
         return value
     
-    def write(self, vaddress, value, bank=0):
+    def write(self, vaddress, value, bank="default", implicit=False, size=4):
         address = self.resolve_address(vaddress, bank)
-        self.logger.info("Writing value (%s) to (vaddress=%s,address=%s) through bank (%s)", value, vaddress, address, bank)
-        super(AbstractBankedAddressableObjectProxy, self).write(address, value, bank)
+        if tracer.proxy:
+            tracer.record(PROXY_WRITE, vaddress, value)
+        super(AbstractBankedAddressableObjectProxy, self).write(address, value, bank, implicit, size)
         
     
-    def raw_read(self, address, bank=0):
-        value = super(AbstractBankedAddressableObjectProxy, self).read(address, bank)
-        self.logger.info("Raw reading value (%s) from address (%s) through bank (%s)", value, address, bank)
-        return value
+    def raw_read(self, address, bank="default", size=4):
+        return super(AbstractBankedAddressableObjectProxy, self).read(address, bank, size=size)
     
-    def raw_write(self, address, value, bank=0):
-        self.logger.info("Raw writing value (%s) to address (%s) through bank (%s)", value, address, bank)
-        super(AbstractBankedAddressableObjectProxy, self).write(address, value, bank)
+    def raw_write(self, address, value, bank="default", size=4):
+        super(AbstractBankedAddressableObjectProxy, self).write(address, value, bank, size=size)
     
-    def resolve_address(self, vaddress, bank=0):
+    def resolve_address(self, vaddress, bank="default"):
         return vaddress
     
     def enable_proxy(self):
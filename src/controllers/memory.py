@@ -1,61 +1,151 @@
-from ctypes import c_uint32
+import mmap
+import struct
 import logging
 
 from controllers.interfaces import AbstractBankedAddressableObject,\
     AbstractBankedAddressableObjectProxy
 from controllers.exceptions.memory_exceptions import ReadOnlyMemory
+from instrumentation.trace import tracer, MEM_READ, MEM_WRITE
 
+# Little endian codecs over the byte backing store, a bytearray or a mapped snapshot image.
+BYTE = struct.Struct('<B')
+HALF_WORD = struct.Struct('<H')
+WORD = struct.Struct('<I')
 
-class SimpleMemory(AbstractBankedAddressableObject):
+DIRTY_PAGE_SHIFT = 12
+
+class MemoryImage(object):
+    '''
+        Backing store helpers shared by the memories, they keep it in self._memory and its
+        size in self._size.
+        
+        Writes flag their page in self._dirty, a byte per page rather than a bit so the write
+        path is a single store.
+    '''
+    def _init_image(self):
+        self._memory = bytearray(self._size)
+        self._dirty = bytearray(((self._size - 1) >> DIRTY_PAGE_SHIFT) + 1)
+    
+    def image(self):
+        # The backing store itself, not a copy.
+        return self._memory
+    
+    def map_image(self, path):
+        '''
+            Backs the memory with a private copy-on-write mapping of the image at path. Pages
+            are only read in when touched and stay shared with the file until written.
+        '''
+        with open(path, 'rb') as image:
+            self._memory = mmap.mmap(image.fileno(), self._size, access=mmap.ACCESS_COPY)
+    
+    def page_size(self):
+        return 1 << DIRTY_PAGE_SHIFT
+    
+    def is_dirty(self, page):
+        return self._dirty[page] != 0
+    
+    def dirty_pages(self):
+        '''
+            Indexes of the pages written since the last clear_dirty().
+        '''
+        dirty = self._dirty
+        pages = []
+        index = dirty.find('\x01')
+        while index != -1:
+            pages.append(index)
+            index = dirty.find('\x01', index + 1)
+        return pages
+    
+    def clear_dirty(self, pages=None):
+        if pages is None:
+            self._dirty[:] = bytearray(len(self._dirty))
+        else:
+            for page in pages:
+                self._dirty[page] = 0
+    
+    def mark_dirty(self):
+        self._dirty[:] = '\x01' * len(self._dirty)
+
+class SimpleMemory(AbstractBankedAddressableObject, MemoryImage):
+    access_sizes = (1, 2, 4)
+    
     def __init__(self, name, memory_size, endiannes):
         AbstractBankedAddressableObject.__init__(self)
         self.logger = logging.getLogger(name)    
         self._size = memory_size * 1024
         self._serve_region(0, self._size)
-        self._memory = (c_uint32 * self._size)()
-        
-    def _read(self, address):
-        address = address & ~3
-        value = self._memory[address]
-        self.logger.info("Reading value (%s) from address (%s)", hex(value), hex(address))
-        return c_uint32(value)
+        self._init_image()
     
-    def _write(self, address, value):
-        self.logger.info("Writing value (%s) to address (%s)", hex(value.value), hex(address))
-        address = address & ~3
-        self._memory[address] = value.value
+    def _read(self, address, size=4):
+        if size == 4:
+            address = address & ~3
+            value = WORD.unpack_from(self._memory, address)[0]
+        elif size == 1:
+            value = BYTE.unpack_from(self._memory, address)[0]
+        else:
+            address = address & ~1
+            value = HALF_WORD.unpack_from(self._memory, address)[0]
+        if tracer.mem_read:
+            tracer.record(MEM_READ, address, value)
+        return value
+    
+    def _write(self, address, value, size=4):
+        if tracer.mem_write:
+            tracer.record(MEM_WRITE, address, value)
+        self._dirty[address >> DIRTY_PAGE_SHIFT] = 1
+        if size == 4:
+            WORD.pack_into(self._memory, address & ~3, value & 0xFFFFFFFF)
+        elif size == 1:
+            BYTE.pack_into(self._memory, address, value & 0xFF)
+        else:
+            HALF_WORD.pack_into(self._memory, address & ~1, value & 0xFFFF)
 
 
 class SimpleROM(SimpleMemory):
     def __init__(self, name, memory_size, endiannes):
         SimpleMemory.__init__(self, name, memory_size, endiannes)
     
-    def _write(self, address, value):
+    def _write(self, address, value, size=4):
         raise ReadOnlyMemory(address)
     
-    def _init_write(self, address, value):
-        super(SimpleROM, self)._write(address, value)
+    def _init_write(self, address, value, size=4):
+        super(SimpleROM, self)._write(address, value, size)
         
 
 
-class SimpleBankedMemory(AbstractBankedAddressableObject):
+class SimpleBankedMemory(AbstractBankedAddressableObject, MemoryImage):
+    access_sizes = (1, 2, 4)
+    
     def __init__(self, name, memory_size, endiannes):
         AbstractBankedAddressableObject.__init__(self)
         self.logger = logging.getLogger(name)    
         self._size = memory_size * 1024
         self._serve_region(0, self._size)
-        self._memory = (c_uint32 * self._size)()
-        
-    def _read(self, address, bank=0):
-        address = address & ~3
-        value = self._memory[address]
-        self.logger.info("Reading value (%s) from address (%s)", hex(value), hex(address))
-        return c_uint32(value)
+        self._init_image()
     
-    def _write(self, address, value, bank=0):
-        self.logger.info("Writing value (%s) to address (%s)", hex(value), hex(address))
-        address = address & ~3
-        self._memory[address] = value.value
+    def _read(self, address, size=4, bank=0):
+        if size == 4:
+            address = address & ~3
+            value = WORD.unpack_from(self._memory, address)[0]
+        elif size == 1:
+            value = BYTE.unpack_from(self._memory, address)[0]
+        else:
+            address = address & ~1
+            value = HALF_WORD.unpack_from(self._memory, address)[0]
+        if tracer.mem_read:
+            tracer.record(MEM_READ, address, value)
+        return value
+    
+    def _write(self, address, value, size=4, bank=0):
+        if tracer.mem_write:
+            tracer.record(MEM_WRITE, address, value)
+        self._dirty[address >> DIRTY_PAGE_SHIFT] = 1
+        if size == 4:
+            WORD.pack_into(self._memory, address & ~3, value & 0xFFFFFFFF)
+        elif size == 1:
+            BYTE.pack_into(self._memory, address, value & 0xFF)
+        else:
+            HALF_WORD.pack_into(self._memory, address & ~1, value & 0xFFFF)
         
 class SimpleMMU(AbstractBankedAddressableObjectProxy):
     def __init__(self, name):
@@ -67,8 +157,8 @@ class SimpleMMU(AbstractBankedAddressableObjectProxy):
     def set_ttb(self, address):
         self.ttb = address
         
-    def resolve_address(self, vaddress):
+    def resolve_address(self, vaddress, bank="default"):
         if self.translation_enabled:
-            return self.raw_read(self.ttb + ((vaddress >> 10) & ~3))
+            return self.raw_read(self.ttb + ((vaddress >> 10) & ~3), bank)
         else:
-            return vaddress
\ No newline at end of file
+            return vaddress
@@ -61,6 +61,8 @@ class SimpleTimer(PeriodicWorker, AbstractInterruptProducer):
         self.name = name
         self.low = TIMER_LOW
         self.high = TIMER_HIGH
+        # Set by host_frontends.replay, our interrupts then come from the event log.
+        self.replaying = False
     
     def get_low(self):
         return self.low
@@ -82,6 +84,15 @@ class SimpleTimer(PeriodicWorker, AbstractInterruptProducer):
         self.logger.info("Setting HIGH to (%s)", value)
         self.high = value
     
+    def get_state(self):
+        return {'low': self.low, 'high': self.high, 'running': self.running}
+    
+    def set_state(self, state):
+        self.low = state['low']
+        self.high = state['high']
+        if state['running'] and not self.running:
+            self.start()
+    
     def start(self):
         sleep_duration = (self.high - self.low) * TIMER_TICK_DURATION
         
@@ -89,6 +100,9 @@ class SimpleTimer(PeriodicWorker, AbstractInterruptProducer):
         self.parameters['sleep_duration'] = sleep_duration
         self.parameters['periodic_task'] = super(SimpleTimer, self).trigger_interrupt
         self.parameters['args'] = TIMER_IRQ
+        if self.replaying:
+            self.logger.info("Replaying, not starting the timer thread")
+            return
         if self.running:
             self.logger.warn("Timer is already running")
             return
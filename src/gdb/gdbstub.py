@@ -22,8 +22,10 @@ GDBStates = {
              }
 
 class GDBStubServer(threading.Thread):
-    def __init__(self, char_driver):
+    def __init__(self, char_driver, context=None):
         threading.Thread.__init__(self)
+        # The soc.context.MachineContext of the machine we debug.
+        self.context = context if context is not None else global_env.context
         self.char_driver = char_driver
         self.PIBuffer = (c_uint8 * PIBuffer_Size)()
         self.PIBuffer_index = 0
@@ -46,15 +48,15 @@ class GDBStubServer(threading.Thread):
                 self.process_byte(input)
             except socket.timeout:
                 # check events now
-                if global_env.dbg_breakpoint_hit:
-                    global_env.dbg_breakpoint_hit = False
+                if self.context.dbg_breakpoint_hit:
+                    self.context.dbg_breakpoint_hit = False
                     self._send_anonymous_stop_signal()
             except:
                 break
         
         logger.critical("Makkah: Terminated via GDBstub")
-        global_env.stop_all()
-        global_env.dbg_event.set()
+        self.context.stop_all()
+        self.context.dbg_event.set()
     
     def _send_anonymous_stop_signal(self):
         str = "S05"
@@ -101,9 +103,9 @@ class GDBStubServer(threading.Thread):
             if char != '$':
                 return
 
-        if global_env.dbg_event.isSet():
+        if self.context.dbg_event.isSet():
             #FIXME: We need to make sure that everything has actually stop before going any further 
-            global_env.dbg_event.clear()
+            self.context.dbg_event.clear()
         else:
             if self.state == GDBStates['RS_IDLE']:
                 if char == '$':
@@ -201,8 +203,8 @@ class GDBStubServer(threading.Thread):
         elif ch == '?':
             # Initializing.
             str = "T05thread:01;"
-            global_env.GDB_IPs = []
-            global_env.GDB_ops = []
+            self.context.GDB_IPs = []
+            self.context.GDB_ops = []
             self._put_packet(self._str_to_buf(str), len(str))
         elif ch == 'H':
             type = self.PIBuffer[index]
@@ -219,13 +221,16 @@ class GDBStubServer(threading.Thread):
                 # Current thread.
                 str = 'QC1'
                 self._put_packet(self._str_to_buf(str), len(str))
+            elif self._packet(index).startswith('Supported') and self.context.checkpoints:
+                str = 'ReverseStep+;ReverseContinue+'
+                self._put_packet(self._str_to_buf(str), len(str))
             else:
                 unknown_command()
         elif ch == 'g':
             #FIXME
             str = ''
             for i in range(16):
-                value = self._tohex(global_env.main_cpu.register_read(i).value, 8, '0')
+                value = self._tohex(self.context.main_cpu.register_read(i).value, 8, '0')
                 logger.critical(value)
                 str += value
                 logger.critical("Reading register (%s) => (%s)", i, value)
@@ -234,7 +239,7 @@ class GDBStubServer(threading.Thread):
             #FIXME
             register_no, index = self._strtoul(self.PIBuffer, index, True)
             if register_no < 16:
-                str = self._tohex(global_env.main_cpu.register_read(register_no).value, 8, '0')
+                str = self._tohex(self.context.main_cpu.register_read(register_no).value, 8, '0')
                 logger.critical("Reading register (%s) => (%s)", register_no, str)
                 self._put_packet(self._str_to_buf(str), len(str))
             else:
@@ -247,13 +252,11 @@ class GDBStubServer(threading.Thread):
             length, _ = self._strtoul(self.PIBuffer, index, True)
             arr_length = length * 2
             _buffer = (c_uint8 * arr_length)()
-            
-            # Change your identity to imitate the cpu that's accessing this memory region
-            global_env.THREAD_ENV.engine_id = global_env.main_cpu.get_name()
+
             i = 0
             try:
                 for _ in range(length / 4):
-                    value = global_env.main_cpu.mmu_read(addr + i).value
+                    value = self.context.main_cpu.mmu_read(addr + i)
                     hex_value = (self._tohex(value, 8, '0'))
                     for index in range(8):
                         _buffer[index] = ord(hex_value[index])
@@ -270,20 +273,31 @@ class GDBStubServer(threading.Thread):
                     str = 'vCont;c;C;s;S'
                     self._put_packet(self._str_to_buf(str), len(str))
                 elif chr(self.PIBuffer[index + 4]) == ';' and chr(self.PIBuffer[index + 5]) == 'c':
-                    global_env.STEPPING = False
-                    global_env.dbg_event.set()
+                    self.context.STEPPING = False
+                    self.context.dbg_event.set()
                 elif chr(self.PIBuffer[index + 4]) == ';' and chr(self.PIBuffer[index + 5]) == 's':
-                    global_env.STEPPING = True
-                    global_env.dbg_event.set()
+                    self.context.STEPPING = True
+                    self.context.dbg_event.set()
+        elif ch == 'b' and self.context.checkpoints and self.context.checkpoints.oldest() is not None:
+            # Reverse execution, the stop is reported like for any breakpoint.
+            if chr(self.PIBuffer[index]) == 's':
+                self.context.checkpoints.reverse_step()
+            elif chr(self.PIBuffer[index]) == 'c':
+                self.context.checkpoints.reverse_continue()
+            else:
+                unknown_command()
         elif ch == 'k':
             logger.critical("Makkah: Terminated via GDBstub")
-            global_env.stop_all()
-            global_env.dbg_event.set()
+            self.context.stop_all()
+            self.context.dbg_event.set()
         else:
             unknown_command()
 
         return GDBStates['RS_IDLE']
 
+    def _packet(self, index=0):
+        return ''.join(chr(self.PIBuffer[i]) for i in range(index, self.PIBuffer_index))
+
     def _str_to_buf(self, str):
         _buffer = (c_uint8 * len(str))()
         for index in range(len(str)):
@@ -316,7 +330,7 @@ class GDBStubServer(threading.Thread):
     def _gdb_breakpoint_insert(self, addr, len, type):
         try:
             if type == 0 or type == 1:
-                global_env.GDB_IPs.append(addr)
+                self.context.GDB_IPs.append(addr)
             else:
                 raise NotImplemented()
             
@@ -330,7 +344,7 @@ class GDBStubServer(threading.Thread):
     def _gdb_breakpoint_remove(self, addr, len, type):
         try:
             if type == 0 or type == 1:
-                global_env.GDB_IPs.remove(addr)
+                self.context.GDB_IPs.remove(addr)
             else:
                 raise NotImplemented()
             
@@ -358,25 +372,25 @@ class GDBStubServer(threading.Thread):
             input = self._latest_command
 
         if input == 'q':
-            global_env.stop_all()
-            global_env.dbg_event.set()
+            self.context.stop_all()
+            self.context.dbg_event.set()
         elif input == 'h':
             logger.critical("In the future this will show you the help.")
         elif input == 'c' or input == 'continue':
             logger.critical("Continue")
-            global_env.dbg_event.set()
+            self.context.dbg_event.set()
         elif input == 'ci':
-            logger.critical(global_env.get_info())
+            logger.critical(self.context.get_info())
             logger.critical("Continue ..")
-            global_env.dbg_event.set()
+            self.context.dbg_event.set()
         elif input == 'n' or input == 'next':
-            global_env.STEPPING = True
-            global_env.dbg_event.set()
+            self.context.STEPPING = True
+            self.context.dbg_event.set()
             logger.critical("Next ..")
         elif input == 's off':
-            global_env.STEPPING = False
+            self.context.STEPPING = False
         elif input == 's on':
-            global_env.STEPPING = True
+            self.context.STEPPING = True
         elif self.break1_re.match(input):
             # Breakpoint decimal
             address = self.break1_number_re.search(input).group()
@@ -386,7 +400,7 @@ class GDBStubServer(threading.Thread):
             address = self.break2_number_re.search(input).group()
             self._gdb_breakpoint_remove(int(address, 16), 4, 0)
         elif input == 'info' or input == 'i':
-            print global_env.get_info()
+            print self.context.get_info()
         else:
             logger.critical("Wrong command.")
     
\ No newline at end of file
@@ -1,48 +1,50 @@
 # Set this to the environment that you wish to see globally.
-import threading
-from threading import Event
+# The machine state lives in context, the default machine context of everything created
+# without one, see soc.context.MachineContext for giving a machine its own.
+#
+# For compatibility the module attributes that used to hold that state (main_cpu, soc,
+# STEPPING ...) are still there, reading or assigning them goes to context.
+import sys
+import types
 
-ENV = {}
+from instrumentation.trace import tracer
+from soc.context import MachineContext, ComponentNotRegistered
 
-dbg_breakpoint_hit = False
-dbg_event = Event()
-dbg_event.set() # single-instruction stepping is OFF by default
+context = MachineContext()
+# The tracer is one per process, it goes with the default machine.
+context.stop_callbacks.append(tracer.close)
 
-# engine_id
-THREAD_ENV = threading.local()
-
-STEPPING = False
-GDB_ops = []
-GDB_IPs = []
-
-class ComponentNotRegistered(Exception):
-    def __init__(self, name):
-        Exception.__init__(self)
-        self.component_name = name
-
-def get_component(self, name):
-        try:
-            return ENV[name]
-        except KeyError:
-            raise ComponentNotRegistered(name)
-
-main_cpu = None
-
-# Stoppable components
-soc = None
-dbg = None
-char_devices = []
+def get_component(name):
+    return context.get_component(name)
 
 def stop_all():
-    if soc:
-        soc.stop()
-
-    if dbg:
-        dbg.stop()
-        
-    for char_device in char_devices:
-        char_device.stop()
+    context.stop_all()
 
 def get_info():
-    info = soc.get_info()
-    return info
+    return context.get_info()
+
+# The MachineContext attributes forwarded to.
+FORWARDED = ('ENV', 'dbg_breakpoint_hit', 'dbg_event', 'STEPPING', 'GDB_ops', 'GDB_IPs',
+             'main_cpu', 'soc', 'dbg', 'checkpoints', 'char_devices', 'stop_callbacks')
+
+def _forward(name):
+    def get(module):
+        return getattr(module.context, name)
+    def set(module, value):
+        setattr(module.context, name, value)
+    return property(get, set)
+
+class _GlobalEnv(types.ModuleType):
+    pass
+
+for _name in FORWARDED:
+    setattr(_GlobalEnv, _name, _forward(_name))
+
+# Module attributes can't be properties, the module is swapped for an instance of a module
+# class that has them. The original is kept alive, python 2 clears the globals of a
+# collected module and our functions still use them.
+_module = sys.modules[__name__]
+_global_env = _GlobalEnv(__name__, __doc__)
+_global_env.__dict__.update(dict((name, value) for name, value in _module.__dict__.items() if name not in FORWARDED))
+_global_env._module = _module
+sys.modules[__name__] = _global_env
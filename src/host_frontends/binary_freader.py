@@ -1,5 +1,4 @@
 import os
-from ctypes import c_uint32
 
 class BinaryFileReader(object):
     def __init__(self, filepath):
@@ -14,7 +13,7 @@ class BinaryFileReader(object):
             i2 = (ord(data[index + 1]) & 0xFF) << 8
             i3 = (ord(data[index + 2]) & 0xFF) << 16
             i4 = (ord(data[index + 3]) & 0xFF) << 24
-            i = c_uint32(i1 | i2 | i3 | i4)
+            i = i1 | i2 | i3 | i4
             
             write_fn(memory_offset + index, i)
 
@@ -0,0 +1,147 @@
+'''
+    Parallel regression runs.
+
+    Every run of a manifest boots its own headless OMAP4 machine in a worker process, runs it
+    to exit_pc or until its limits and checks the expected results. The manifest is a JSON
+    list of runs:
+
+        [{"name"             : "boot",
+          "image"            : "../examples/tinyos/output.bin",
+          "snapshot"         : null,
+          "boot"             : {"pc": "0x40300000", "registers": {"0": 0}},
+          "exit_pc"          : "0x40300100",
+          "max_instructions" : 1000000,
+          "timeout"          : 60,
+          "expect"           : {"status": "ok", "registers": {"0": 5}, "memory": {"0x40300200": 1}}}]
+
+    image or snapshot says what to boot, boot overrides the pc and registers afterwards.
+    Addresses may be given as strings in any base. The report gets one line per run as soon as
+    it finishes, CSV when its name ends with .csv and JSON lines otherwise:
+
+        python -m host_frontends.farm manifest.json report.csv [processes]
+
+    Runs are spread over a multiprocessing pool, one process per host cpu by default.
+'''
+import sys
+import csv
+import json
+import time
+import traceback
+import multiprocessing
+
+from soc.omap4 import OMAP4
+from soc.context import MachineContext
+from host_frontends.fork_server import run_until
+
+COLUMNS = ('name', 'status', 'passed', 'icount', 'skipped', 'seconds', 'mips', 'pc', 'mismatches', 'error')
+
+def _int(value):
+    return int(value, 0) if isinstance(value, basestring) else value
+
+def run(spec):
+    '''
+        Runs one manifest entry, returns its report line. Never raises.
+    '''
+    result = dict((column, None) for column in COLUMNS)
+    result['name'] = spec.get('name')
+    try:
+        machine = OMAP4(spec.get('snapshot'), context=MachineContext(), os_path=spec.get('image'))
+        machine.prepare()
+        cpu = machine.mpu.cpu0
+        boot = spec.get('boot', {})
+        for register, value in boot.get('registers', {}).items():
+            cpu.register_write(int(register), _int(value))
+        if 'pc' in boot:
+            cpu.set_ip(_int(boot['pc']))
+
+        limit = cpu.icount + spec.get('max_instructions', 1000000)
+        timeout = spec.get('timeout', 0)
+
+        start = time.time()
+        first = cpu.icount - cpu.idle_skipped
+        status = run_until(cpu, _int(spec.get('exit_pc')), limit, start + timeout if timeout else None)
+        seconds = time.time() - start
+
+        result['status'] = status
+        executed = cpu.icount - cpu.idle_skipped - first
+        result['icount'] = cpu.icount
+        result['skipped'] = cpu.idle_skipped
+        result['pc'] = cpu.ip.value
+        result['seconds'] = round(seconds, 3)
+        # Idle fast-forwarding would inflate it.
+        result['mips'] = round(executed / seconds / 1e6, 4) if seconds else None
+        result['mismatches'] = check(cpu, result, spec.get('expect', {}))
+        result['passed'] = not result['mismatches']
+    except Exception:
+        result['status'] = 'crash'
+        result['passed'] = False
+        result['error'] = traceback.format_exc()
+    return result
+
+def check(cpu, result, expect):
+    '''
+        The differences between expect and where the run ended, as strings.
+    '''
+    mismatches = []
+    if result['status'] != expect.get('status', 'ok'):
+        mismatches.append("status %s" % result['status'])
+    if 'pc' in expect and cpu.ip.value != _int(expect['pc']):
+        mismatches.append("pc 0x%x" % cpu.ip.value)
+    for register, value in sorted(expect.get('registers', {}).items()):
+        actual = cpu.register_read(int(register)).value
+        if actual != _int(value):
+            mismatches.append("r%s 0x%x" % (register, actual))
+    for address, value in sorted(expect.get('memory', {}).items()):
+        actual = cpu.mmu_read(_int(address))
+        if actual != _int(value):
+            mismatches.append("%s 0x%x" % (address, actual))
+    return mismatches
+
+class Report(object):
+    def __init__(self, path):
+        self._file = open(path, 'wb' if path.endswith('.csv') else 'w')
+        self._csv = None
+        if path.endswith('.csv'):
+            self._csv = csv.DictWriter(self._file, COLUMNS)
+            self._csv.writeheader()
+
+    def write(self, result):
+        if self._csv is not None:
+            row = dict(result)
+            row['mismatches'] = '; '.join(row['mismatches'] or [])
+            self._csv.writerow(row)
+        else:
+            self._file.write(json.dumps(result) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+def run_manifest(manifest, report_path, processes=None):
+    '''
+        Runs every entry of manifest and streams the results into report_path as they come.
+        Returns the results in completion order.
+    '''
+    report = Report(report_path)
+    pool = multiprocessing.Pool(processes or multiprocessing.cpu_count())
+    results = []
+    try:
+        for result in pool.imap_unordered(run, manifest):
+            report.write(result)
+            results.append(result)
+    finally:
+        pool.close()
+        pool.join()
+        report.close()
+    return results
+
+if __name__ == "__main__":
+    with open(sys.argv[1]) as manifest_file:
+        manifest = json.load(manifest_file)
+    processes = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    results = run_manifest(manifest, sys.argv[2], processes)
+    failed = [result['name'] for result in results if not result['passed']]
+    for name in failed:
+        print("FAILED %s" % name)
+    print("%d runs, %d failed" % (len(results), len(failed)))
+    sys.exit(1 if failed else 0)
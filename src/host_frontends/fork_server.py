@@ -0,0 +1,166 @@
+'''
+    Fork server for test and fuzz campaigns.
+
+    The machine is booted once, then every testcase runs in a fork()ed child that inherits the
+    booted machine copy-on-write. The child writes the input into guest memory, runs until the
+    guest reaches exit_pc, faults, or exceeds max_instructions, and reports back through a pipe.
+
+    serve() reads one testcase path per line and answers one JSON line per testcase:
+
+        {"status": "ok", "icount": 1234, "pc": 1076887824, "coverage": "<base64 zlib bitmap>"}
+
+    status is ok, timeout (instruction budget or host timeout), fault (the guest took an
+    undefined instruction or abort exception) or crash (the simulator raised).
+'''
+import os
+import sys
+import json
+import zlib
+import time
+import base64
+import signal
+import traceback
+
+from instrumentation.coverage import EdgeCoverage
+
+# Exception vector offsets treated as guest faults: undefined, prefetch abort, data abort.
+FAULT_VECTORS = (0x04, 0x0C, 0x10)
+
+class GuestFault(Exception):
+    def __init__(self, pc, vector):
+        Exception.__init__(self)
+        self.pc = pc
+        self.vector = vector
+
+class HostTimeout(Exception):
+    pass
+
+# Instructions between two checks of a host deadline.
+DEADLINE_CHECK = 0x4000
+
+def raise_on_fault(cpu, pc, vector):
+    '''
+        An exception plugin, see ARMCortexA9.register_plugin.
+    '''
+    if vector & 0x1F in FAULT_VECTORS:
+        raise GuestFault(pc, vector)
+
+def run_until(cpu, exit_pc, limit, deadline=None):
+    '''
+        Executes cpu until the guest reaches exit_pc, faults or has retired limit instructions,
+        returns ok, fault or timeout. deadline is a time.time() after which it's a timeout too.
+        
+        It is checked from a scheduled event every DEADLINE_CHECK instructions, idle guests
+        skipping or spinning through their instructions pass there as well.
+    '''
+    def check_deadline(cpu):
+        if time.time() > deadline:
+            raise HostTimeout()
+        cpu.schedule(cpu.icount + DEADLINE_CHECK, check_deadline)
+    
+    # An idle guest times out without spinning through the budget.
+    cpu.virtual_time = True
+    cpu.schedule(limit, lambda cpu: None)
+    if deadline is not None:
+        cpu.schedule(cpu.icount + DEADLINE_CHECK, check_deadline)
+    cpu.register_plugin('exception', raise_on_fault)
+    try:
+        while cpu.icount < limit:
+            if cpu.ip.value == exit_pc:
+                return 'ok'
+            cpu.execute()
+    except GuestFault:
+        return 'fault'
+    except HostTimeout:
+        pass
+    return 'timeout'
+
+class ForkServer(object):
+    def __init__(self, cpu, input_address, exit_pc=None, max_instructions=1000000, timeout=0, length_address=None):
+        self.cpu = cpu
+        self.input_address = input_address
+        # The input length is written there as a word, when given.
+        self.length_address = length_address
+        self.exit_pc = exit_pc
+        self.max_instructions = max_instructions
+        # Host seconds, 0 for none.
+        self.timeout = timeout
+    
+    def boot(self, pc=None, icount=None):
+        '''
+            Runs the machine until it reaches pc or icount instructions, whichever comes first.
+        '''
+        cpu = self.cpu
+        if icount is not None:
+            # An idle guest then jumps there instead of spinning.
+            cpu.virtual_time = True
+            cpu.schedule(icount, lambda cpu: None)
+        while True:
+            if pc is not None and cpu.ip.value == pc:
+                break
+            if icount is not None and cpu.icount >= icount:
+                break
+            cpu.execute()
+    
+    def run_testcase(self, data):
+        reader, writer = os.pipe()
+        pid = os.fork()
+        if not pid:
+            os.close(reader)
+            try:
+                result = self._child(data)
+            except Exception:
+                result = {'status': 'crash', 'error': traceback.format_exc()}
+            with os.fdopen(writer, 'w') as pipe:
+                pipe.write(json.dumps(result))
+            os._exit(0)
+        
+        os.close(writer)
+        with os.fdopen(reader) as pipe:
+            output = pipe.read()
+        os.waitpid(pid, 0)
+        
+        if not output:
+            return {'status': 'crash', 'error': 'child died without reporting'}
+        return json.loads(output)
+    
+    def _child(self, data):
+        cpu = self.cpu
+        port = cpu.bus_port
+        for offset in range(len(data)):
+            port.write(self.input_address + offset, ord(data[offset]), size=1)
+        if self.length_address is not None:
+            port.write(self.length_address, len(data))
+        
+        coverage = EdgeCoverage(cpu)
+        coverage.attach()
+        
+        if self.timeout:
+            signal.signal(signal.SIGALRM, self._on_alarm)
+            signal.alarm(self.timeout)
+        try:
+            status = run_until(cpu, self.exit_pc, cpu.icount + self.max_instructions)
+        finally:
+            # Not to go off while the result is put together.
+            signal.alarm(0)
+        
+        return {
+                'status'    : status,
+                'icount'    : cpu.icount,
+                'pc'        : cpu.ip.value,
+                'coverage'  : base64.b64encode(zlib.compress(bytes(coverage.bitmap)))
+               }
+    
+    def _on_alarm(self, signum, frame):
+        raise HostTimeout()
+    
+    def serve(self, requests=sys.stdin, responses=sys.stdout):
+        for line in iter(requests.readline, ''):
+            path = line.strip()
+            if not path:
+                continue
+            with open(path, 'rb') as testcase:
+                result = self.run_testcase(testcase.read())
+            result['testcase'] = path
+            responses.write(json.dumps(result) + '\n')
+            responses.flush()
@@ -0,0 +1,135 @@
+'''
+    Record and replay of the asynchronous interrupts of a run.
+
+    EventRecorder logs every interrupt asserted from another thread with the number of
+    instructions retired when the guest observed it, EventReplayer asserts the same interrupts
+    again at the same instructions. The log is one JSON object per line, after a
+    {"version": 1} header:
+
+        {"icount": 1234, "kind": "irq", "source": "cpu0", "value": 1}
+
+    Interrupts asserted from other threads (timers, interrupt controllers) are handed over to
+    the cpu thread with cpu.post, so they always land between two instructions. Interrupts the
+    cpu raises itself (SVC) are deterministic and neither recorded nor replayed.
+
+    While replaying, timers attached with timer() never start their thread and live interrupts
+    from other threads are dropped, the run does not sleep and only depends on the log.
+
+    Interrupts are the only asynchronous input of the machine, there is no guest serial port
+    and no device reads the host time, so they are all the log covers.
+'''
+import json
+import logging
+import threading
+
+LOG_VERSION = 1
+
+IRQ         = 'irq'
+
+class UnsupportedLogVersion(Exception):
+    def __init__(self, version):
+        Exception.__init__(self)
+        self.version = version
+
+class EventLog(object):
+    def __init__(self, path):
+        self.path = path
+        self.cpu = None
+        self.logger = logging.getLogger("event log")
+        self._interrupt_triggered = None
+        self._attach_thread = None
+
+    def attach(self, cpu):
+        '''
+            Hooks cpu.interrupt_triggered, attach before the cpu executes its first instruction.
+        '''
+        self.cpu = cpu
+        self._attach_thread = threading.current_thread()
+        self._interrupt_triggered = cpu.interrupt_triggered
+        cpu.interrupt_triggered = self._on_interrupt
+
+    def detach(self):
+        if self.cpu is not None:
+            del self.cpu.interrupt_triggered
+            self.cpu = None
+
+    def _from_cpu(self):
+        # execute() may also be driven without run(), e.g. by the fork server.
+        thread = self.cpu.run_thread or self._attach_thread
+        return threading.current_thread() is thread
+
+    def _icount(self):
+        return self.cpu.icount if self.cpu is not None else 0
+
+    def close(self):
+        self.detach()
+
+class EventRecorder(EventLog):
+    def __init__(self, path):
+        EventLog.__init__(self, path)
+        self._file = open(path, 'w')
+        self._file.write(json.dumps({'version': LOG_VERSION}) + '\n')
+        # close() comes from whichever thread stops the machine.
+        self._lock = threading.Lock()
+        self.events = 0
+
+    def log(self, kind, source, value):
+        event = {'icount': self._icount(), 'kind': kind, 'source': source, 'value': value}
+        with self._lock:
+            self._file.write(json.dumps(event) + '\n')
+            self.events += 1
+
+    def _on_interrupt(self, returned_irq):
+        if self._from_cpu():
+            self._interrupt_triggered(returned_irq)
+            return
+
+        def deliver(cpu):
+            self.log(IRQ, cpu.name, returned_irq)
+            self._interrupt_triggered(returned_irq)
+        self.cpu.post(deliver)
+
+    def timer(self, timer):
+        pass
+
+    def close(self):
+        EventLog.close(self)
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+        self.logger.warning("Recorded (%s) events to (%s)", self.events, self.path)
+
+class EventReplayer(EventLog):
+    def __init__(self, path):
+        EventLog.__init__(self, path)
+        self._interrupts = []
+        with open(path) as log:
+            header = json.loads(log.readline())
+            if header.get('version') != LOG_VERSION:
+                raise UnsupportedLogVersion(header.get('version'))
+            for line in log:
+                event = json.loads(line)
+                if event['kind'] == IRQ:
+                    self._interrupts.append((event['icount'], event['value']))
+
+    def attach(self, cpu):
+        EventLog.attach(self, cpu)
+        for icount, returned_irq in self._interrupts:
+            cpu.schedule(icount, self._deliver(returned_irq))
+
+    def _deliver(self, returned_irq):
+        return lambda cpu: self._interrupt_triggered(returned_irq)
+
+    def _on_interrupt(self, returned_irq):
+        if self._from_cpu():
+            self._interrupt_triggered(returned_irq)
+        else:
+            self.logger.debug("Dropping live interrupt (%s) while replaying", returned_irq)
+
+    def timer(self, timer):
+        '''
+            Keeps timer from running, its interrupts come from the log.
+        '''
+        if timer.running:
+            timer.stop()
+        timer.replaying = True
@@ -0,0 +1,108 @@
+'''
+    Exact guest call graph profiler.
+
+    A shadow call stack is pushed when BL branches (the return address is the lr it
+    wrote) and when an exception is taken (the return address is the interrupted pc).
+    Returns aren't decoded: whatever writes the pc, BX lr, POP {pc}, LDM or an exception
+    return, a frame is popped as soon as the next fetched pc is its return address.
+
+    Every executed instruction is accounted to the current stack, the result is written in
+    the collapsed stack format read by flamegraph.pl and inclusive/exclusive counts per
+    function are derived from it.
+'''
+
+class CallGraphProfiler(object):
+    def __init__(self, cpu, symbols=None):
+        self.cpu = cpu
+        self.symbols = symbols
+        # [(function, return address)]
+        self._stack = []
+        # return address => frames waiting for it
+        self._returns = {}
+        self._path = ""
+        # "f;g;h" => instructions
+        self.stacks = {}
+        # (caller, callee) => calls
+        self.calls = {}
+    
+    def _name(self, address):
+        if self.symbols is not None:
+            return self.symbols.name(address)
+        return "0x%08x" % address
+    
+    def _push(self, target, return_address):
+        name = self._name(target)
+        if self._stack:
+            edge = (self._stack[-1][0], name)
+            self.calls[edge] = self.calls.get(edge, 0) + 1
+            self._path = self._path + ';' + name
+        else:
+            self._path = name
+        self._stack.append((name, return_address))
+        self._returns[return_address] = self._returns.get(return_address, 0) + 1
+    
+    def _pop_to(self, return_address):
+        # Unwinds every frame above the one returning to return_address as well.
+        while self._stack:
+            _, frame_return = self._stack.pop()
+            count = self._returns[frame_return] - 1
+            if count:
+                self._returns[frame_return] = count
+            else:
+                del self._returns[frame_return]
+            if frame_return == return_address:
+                break
+        self._path = ';'.join(name for name, _ in self._stack)
+    
+    def attach(self):
+        self._push(self.cpu.ip.value, None)
+        self.cpu.register_plugin('insn', self._on_insn)
+        self.cpu.register_plugin('branch', self._on_branch)
+        self.cpu.register_plugin('exception', self._on_exception)
+    
+    def detach(self):
+        for event, callback in (('insn', self._on_insn), ('branch', self._on_branch), ('exception', self._on_exception)):
+            self.cpu.unregister_plugin(event, callback)
+    
+    def _on_insn(self, cpu, pc, op):
+        if pc in self._returns:
+            self._pop_to(pc)
+        path = self._path
+        self.stacks[path] = self.stacks.get(path, 0) + 1
+    
+    def _on_branch(self, cpu, pc, target):
+        if (cpu.op & cpu.BL_OP_MASK) == cpu.BL_OP:
+            self._push(target, cpu.register_read(14).value)
+    
+    def _on_exception(self, cpu, pc, vector):
+        self._push(vector, pc)
+    
+    def functions(self):
+        '''
+            function => (inclusive, exclusive) instructions. Recursive frames are only
+            counted once towards the inclusive count.
+        '''
+        inclusive = {}
+        exclusive = {}
+        for path, count in self.stacks.items():
+            frames = path.split(';')
+            exclusive[frames[-1]] = exclusive.get(frames[-1], 0) + count
+            for name in set(frames):
+                inclusive[name] = inclusive.get(name, 0) + count
+        return dict((name, (inclusive[name], exclusive.get(name, 0))) for name in inclusive)
+    
+    def write_collapsed(self, path):
+        with open(path, 'w') as output:
+            for stack, count in sorted(self.stacks.items()):
+                output.write("%s %d\n" % (stack, count))
+    
+    def report(self, top=20):
+        functions = sorted(self.functions().items(), key=lambda item: item[1][0], reverse=True)
+        lines = ["%12s %12s %s" % ("inclusive", "exclusive", "function")]
+        for name, (inclusive, exclusive) in functions[:top]:
+            lines.append("%12d %12d %s" % (inclusive, exclusive, name))
+        
+        lines.append("")
+        for (caller, callee), count in sorted(self.calls.items(), key=lambda item: item[1], reverse=True)[:top]:
+            lines.append("%8d %s -> %s" % (count, caller, callee))
+        return '\n'.join(lines)
@@ -0,0 +1,210 @@
+'''
+    Guest code coverage.
+
+    Executed addresses are kept in one bitmap per 4KB code page (one bit per half-word, so
+    Thumb code fits too). Optionally the entries of every basic block are counted, a block
+    starting wherever execution doesn't fall through from the previous word.
+
+    Addresses are mapped back to source lines with an addr2line style map, either a file of
+
+        0x40300000 entry.S:12
+
+    lines or by running addr2line on the ELF image. The result is written as lcov tracefiles
+    (genhtml, CI coverage tools) or JSON.
+'''
+import json
+import subprocess
+
+PAGE_SHIFT = 12
+PAGE_MASK = (1 << PAGE_SHIFT) - 1
+# One bit per half-word.
+PAGE_BITMAP_SIZE = (1 << PAGE_SHIFT) >> 4
+
+class Coverage(object):
+    def __init__(self, cpu, block_counts=False):
+        self.cpu = cpu
+        self.block_counts = block_counts
+        # page number => bytearray bitmap
+        self.pages = {}
+        # block leader address => entries
+        self.blocks = {}
+        self._last_page = None
+        self._last_bitmap = None
+        self._next_pc = None
+    
+    def attach(self):
+        self.cpu.register_plugin('insn', self._on_insn)
+    
+    def detach(self):
+        self.cpu.unregister_plugin('insn', self._on_insn)
+    
+    def _on_insn(self, cpu, pc, op):
+        page = pc >> PAGE_SHIFT
+        if page != self._last_page:
+            bitmap = self.pages.get(page)
+            if bitmap is None:
+                bitmap = self.pages[page] = bytearray(PAGE_BITMAP_SIZE)
+            self._last_page = page
+            self._last_bitmap = bitmap
+        
+        offset = (pc & PAGE_MASK) >> 1
+        self._last_bitmap[offset >> 3] |= 1 << (offset & 7)
+        
+        if self.block_counts:
+            if pc != self._next_pc:
+                self.blocks[pc] = self.blocks.get(pc, 0) + 1
+            self._next_pc = pc + 4
+    
+    def executed(self, address):
+        bitmap = self.pages.get(address >> PAGE_SHIFT)
+        if bitmap is None:
+            return False
+        offset = (address & PAGE_MASK) >> 1
+        return (bitmap[offset >> 3] >> (offset & 7)) & 1 == 1
+    
+    def executed_addresses(self):
+        for page in sorted(self.pages):
+            bitmap = self.pages[page]
+            for index, byte in enumerate(bitmap):
+                if not byte:
+                    continue
+                for bit in range(8):
+                    if byte & (1 << bit):
+                        yield (page << PAGE_SHIFT) | (((index << 3) | bit) << 1)
+    
+    def line_hits(self, line_map, addresses=None):
+        '''
+            {file: {line: hits}} over addresses (the executed ones by default). A line is hit
+            once per block entered on it with block counts, once if executed otherwise.
+        '''
+        if addresses is None:
+            addresses = self.executed_addresses()
+        
+        files = {}
+        for address in addresses:
+            location = line_map.get(address)
+            if location is None:
+                continue
+            
+            path, line = location
+            lines = files.setdefault(path, {})
+            hits = 0
+            if self.executed(address):
+                hits = self.blocks.get(address, 1) if self.block_counts else 1
+            lines[line] = max(lines.get(line, 0), hits)
+        return files
+    
+    def write_json(self, path, line_map=None, addresses=None):
+        report = {
+                    'executed'  : ["0x%08x" % address for address in self.executed_addresses()],
+                    'blocks'    : dict(("0x%08x" % address, hits) for address, hits in self.blocks.items())
+                 }
+        if line_map is not None:
+            report['lines'] = self.line_hits(line_map, addresses)
+        
+        with open(path, 'w') as output:
+            json.dump(report, output, indent=4, sort_keys=True)
+    
+    def write_lcov(self, path, line_map, symbols, addresses=None):
+        '''
+            All the instructions of every sized function in symbols are mapped, so lines that
+            were never executed are reported too. addresses defaults to code_addresses(symbols),
+            pass it when it was already computed for line_map.
+        '''
+        if addresses is None:
+            addresses = code_addresses(symbols)
+        files = self.line_hits(line_map, addresses)
+        
+        functions = {}
+        for address, size, name in symbols.functions():
+            location = line_map.get(address)
+            if size and location is not None:
+                hits = self.blocks.get(address, 0) if self.block_counts else int(self.executed(address))
+                functions.setdefault(location[0], []).append((location[1], name, hits))
+        
+        with open(path, 'w') as output:
+            output.write("TN:\n")
+            for source in sorted(files):
+                lines = files[source]
+                output.write("SF:%s\n" % source)
+                source_functions = functions.get(source, [])
+                for line, name, hits in source_functions:
+                    output.write("FN:%d,%s\n" % (line, name))
+                for line, name, hits in source_functions:
+                    output.write("FNDA:%d,%s\n" % (hits, name))
+                output.write("FNF:%d\n" % len(source_functions))
+                output.write("FNH:%d\n" % len([hits for _, _, hits in source_functions if hits]))
+                for line in sorted(lines):
+                    output.write("DA:%d,%d\n" % (line, lines[line]))
+                output.write("LF:%d\n" % len(lines))
+                output.write("LH:%d\n" % len([hits for hits in lines.values() if hits]))
+                output.write("end_of_record\n")
+
+class EdgeCoverage(object):
+    '''
+        AFL style edge coverage, a byte per hashed (previous pc, pc) pair counting its hits
+        and saturating at 255.
+    '''
+    def __init__(self, cpu, size=1 << 16):
+        self.cpu = cpu
+        self.bitmap = bytearray(size)
+        self._mask = size - 1
+        self._previous = 0
+    
+    def attach(self):
+        self.cpu.register_plugin('insn', self._on_insn)
+    
+    def detach(self):
+        self.cpu.unregister_plugin('insn', self._on_insn)
+    
+    def _on_insn(self, cpu, pc, op):
+        location = (pc >> 2) & self._mask
+        index = location ^ self._previous
+        if self.bitmap[index] != 255:
+            self.bitmap[index] += 1
+        self._previous = location >> 1
+
+def code_addresses(symbols):
+    addresses = []
+    for address, size, _ in symbols.functions():
+        addresses.extend(range(address, address + size, 4))
+    return addresses
+
+def _parse_location(location):
+    # file:line, possibly followed by " (discriminator n)"
+    location = location.split(' ')[0]
+    path, _, line = location.rpartition(':')
+    if not path or path == '??' or not line.isdigit() or line == '0':
+        return None
+    return path, int(line)
+
+def load_line_map(path):
+    '''
+        address => (file, line) from "address file:line" lines.
+    '''
+    line_map = {}
+    with open(path) as map_file:
+        for line in map_file:
+            fields = line.split(None, 1)
+            if len(fields) != 2:
+                continue
+            location = _parse_location(fields[1].strip())
+            if location is not None:
+                line_map[int(fields[0], 16)] = location
+    return line_map
+
+def addr2line_map(elf_path, addresses, addr2line="arm-none-eabi-addr2line"):
+    '''
+        address => (file, line) for addresses, resolved by addr2line from the DWARF line
+        tables of the image.
+    '''
+    addresses = list(addresses)
+    process = subprocess.Popen([addr2line, '-e', elf_path], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    output, _ = process.communicate(''.join("0x%x\n" % address for address in addresses))
+    
+    line_map = {}
+    for address, location in zip(addresses, output.splitlines()):
+        location = _parse_location(location.strip())
+        if location is not None:
+            line_map[address] = location
+    return line_map
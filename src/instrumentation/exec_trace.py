@@ -0,0 +1,121 @@
+'''
+    Per instruction execution recorder for ARMCortexA9.
+
+    Every executed instruction becomes a fixed-size record in a preallocated buffer:
+
+        icount, pc, opcode, cpsr (after execution), mem_addr, flags
+
+    mem_addr is the last data address the instruction accessed through the mmu and flags tells
+    whether it was read (MEM_READ) and/or written (MEM_WRITE).
+
+    With a path the buffer is spilled to a .npy file whenever it fills up, so the whole run is
+    kept and instrumentation.trace_analysis can memory map it. Without one the buffer is a ring
+    that only keeps the last records, dump() writes them out.
+
+    The recorder is an insn and mem plugin of the cpu. A record is completed when the next
+    instruction is fetched, that's when the cpsr it left behind is known.
+'''
+import struct
+
+MEM_READ    = 0x1
+MEM_WRITE   = 0x2
+
+RECORD = struct.Struct('<QIIIII')
+
+# numpy dtype of the records, trace_analysis loads the file as a structured array.
+DESCR = [('icount', '<u8'), ('pc', '<u4'), ('opcode', '<u4'), ('cpsr', '<u4'), ('mem_addr', '<u4'), ('flags', '<u4')]
+
+NPY_MAGIC = '\x93NUMPY\x01\x00'
+# Fixed so the header can be rewritten in place with the final record count.
+NPY_HEADER_SIZE = 256
+
+def npy_header(count):
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (DESCR, count)
+    header = header.ljust(NPY_HEADER_SIZE - len(NPY_MAGIC) - 2 - 1) + '\n'
+    return NPY_MAGIC + struct.pack('<H', len(header)) + header
+
+class ExecutionRecorder(object):
+    def __init__(self, path=None, capacity=1 << 16):
+        self.path = path
+        self.capacity = capacity
+        self._buffer = bytearray(capacity * RECORD.size)
+        # Records produced so far, slot = count % capacity.
+        self.count = 0
+        self.spilled = 0
+        self.cpu = None
+        # The instruction being executed, None before the first one.
+        self._pending = None
+        self._mem_address = 0
+        self._flags = 0
+        self._file = None
+        if path:
+            self._file = open(path, 'wb')
+            self._file.write(npy_header(0))
+    
+    def attach(self, cpu):
+        self.cpu = cpu
+        cpu.register_plugin('insn', self._on_insn)
+        cpu.register_plugin('mem', self._on_mem)
+    
+    def detach(self):
+        self._complete()
+        self.cpu.unregister_plugin('insn', self._on_insn)
+        self.cpu.unregister_plugin('mem', self._on_mem)
+        self.cpu = None
+    
+    def _complete(self):
+        if self._pending is not None:
+            icount, pc, op = self._pending
+            self.record(icount, pc, op, self.cpu.cpsr.value, self._mem_address if self._flags else 0, self._flags)
+            self._pending = None
+    
+    def _on_insn(self, cpu, pc, op):
+        self._complete()
+        # icount is bumped once the instruction starts executing.
+        self._pending = (cpu.icount + 1, pc, op)
+        self._flags = 0
+    
+    def _on_mem(self, cpu, vaddress, value, size, write):
+        self._mem_address = vaddress
+        self._flags |= MEM_WRITE if write else MEM_READ
+    
+    def record(self, icount, pc, opcode, cpsr, mem_address, flags):
+        slot = self.count % self.capacity
+        RECORD.pack_into(self._buffer, slot * RECORD.size, icount, pc, opcode, cpsr, mem_address, flags)
+        self.count += 1
+        if self._file is not None and slot == self.capacity - 1:
+            self._spill()
+    
+    def _spill(self):
+        pending = self.count - self.spilled
+        self._file.write(bytes(self._buffer[:pending * RECORD.size]))
+        self.spilled = self.count
+    
+    def records(self):
+        '''
+            The records still held by the buffer, oldest first.
+        '''
+        if self._file is not None:
+            return bytes(self._buffer[:(self.count - self.spilled) * RECORD.size])
+        
+        if self.count <= self.capacity:
+            return bytes(self._buffer[:self.count * RECORD.size])
+        split = (self.count % self.capacity) * RECORD.size
+        return bytes(self._buffer[split:] + self._buffer[:split])
+    
+    def dump(self, path):
+        data = self.records()
+        with open(path, 'wb') as npy:
+            npy.write(npy_header(len(data) // RECORD.size))
+            npy.write(data)
+    
+    def close(self):
+        if self.cpu is not None:
+            self.detach()
+        
+        if self._file is not None:
+            self._spill()
+            self._file.seek(0)
+            self._file.write(npy_header(self.count))
+            self._file.close()
+            self._file = None
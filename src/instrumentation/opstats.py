@@ -0,0 +1,100 @@
+'''
+    Per op_handlers entry execution counts and host timing of ARMCortexA9.
+
+    While enabled every entry of the cpu op_handlers is wrapped with a counter, and one
+    call out of sample_period is timed into a log2 histogram (bucket n holds the calls that
+    took [2^(n-1), 2^n) microseconds).
+    
+    enable and disable nest, a cpu keeps one instance in cpu.opstats that the -opstats run and
+    the sampled mode windows can both turn on.
+'''
+import json
+import time
+
+class OpcodeStatistics(object):
+    def __init__(self, cpu, sample_period=64):
+        self.cpu = cpu
+        self.sample_period = sample_period
+        # name => calls
+        self.counts = {}
+        # name => (timed calls, total seconds)
+        self.timings = {}
+        # name => [calls per log2 microseconds bucket]
+        self.histograms = {}
+        self._handlers = None
+        self._enabled = 0
+    
+    def enable(self):
+        self._enabled += 1
+        if self._enabled > 1:
+            return
+        self._handlers = dict(self.cpu.op_handlers)
+        for name, handler in self._handlers.items():
+            self.cpu.op_handlers[name] = self._wrap(name, handler)
+        self.cpu.opstats = self
+    
+    def disable(self):
+        self._enabled -= 1
+        if self._enabled:
+            return
+        self.cpu.op_handlers.update(self._handlers)
+        self._handlers = None
+        self.cpu.opstats = None
+    
+    def _wrap(self, name, handler):
+        counts = self.counts
+        timings = self.timings
+        # Kept across enable/disable, sampled mode turns the statistics on and off.
+        histogram = self.histograms.setdefault(name, [0] * 32)
+        period = self.sample_period
+        counts.setdefault(name, 0)
+        timings.setdefault(name, (0, 0.0))
+        
+        def counted_handler(op):
+            count = counts[name] = counts[name] + 1
+            if count % period:
+                return handler(op)
+            
+            start = time.time()
+            skip = handler(op)
+            elapsed = time.time() - start
+            
+            timed, total = timings[name]
+            timings[name] = (timed + 1, total + elapsed)
+            histogram[min(int(elapsed * 1000000).bit_length(), 31)] += 1
+            return skip
+        return counted_handler
+    
+    def counters(self):
+        return dict(self.counts)
+    
+    def statistics(self):
+        '''
+            name => dict of calls, mean_us (of the timed calls), estimated_s (mean * calls)
+            and the log2 microseconds histogram.
+        '''
+        result = {}
+        for name, count in self.counts.items():
+            if not count:
+                continue
+            timed, total = self.timings[name]
+            mean = total / timed if timed else 0.0
+            result[name] = {
+                            'calls'         : count,
+                            'timed_calls'   : timed,
+                            'mean_us'       : mean * 1000000,
+                            'estimated_s'   : mean * count,
+                            'histogram_us'  : self.histograms[name]
+                           }
+        return result
+    
+    def report(self, top=20):
+        statistics = sorted(self.statistics().items(), key=lambda item: item[1]['calls'], reverse=True)
+        lines = ["%-20s %12s %10s %12s" % ("handler", "calls", "mean us", "estimated s")]
+        for name, stats in statistics[:top]:
+            lines.append("%-20s %12d %10.2f %12.3f" % (name, stats['calls'], stats['mean_us'], stats['estimated_s']))
+        return '\n'.join(lines)
+    
+    def write_json(self, path):
+        with open(path, 'w') as output:
+            json.dump({'icount': self.cpu.icount, 'handlers': self.statistics()}, output, indent=4, sort_keys=True)
@@ -0,0 +1,148 @@
+'''
+    Sampled detailed simulation.
+
+    The cpu runs functionally, with no instrumentation at all, and every period instructions
+    the detailed components are enabled for a window of instructions. A component has
+    enable() and disable() and, if it measures anything, counters() returning cumulative
+    {name: count}.
+
+    Every window gives a per instruction rate of each counter. The whole run is estimated as
+    the mean rate times the executed instructions, with a normal approximation confidence
+    interval over the windows.
+'''
+import json
+import math
+import threading
+
+from instrumentation.trace import tracer
+
+# Seconds between two checks that the cpu thread is still there to close the window.
+STOP_POLL = 0.1
+
+class TraceWindow(object):
+    '''
+        Turns the tracer categories on only inside the windows, the sink stays set.
+    '''
+    def __init__(self, categories):
+        self.categories = categories
+    
+    def enable(self):
+        tracer.set_categories(self.categories)
+    
+    def disable(self):
+        tracer.set_categories(())
+
+class SampledDetailedMode(object):
+    def __init__(self, cpu, components, period=1000000, window=10000):
+        if window > period:
+            # The windows would run back to back and the estimates be off.
+            raise ValueError("window (%s) should not be longer than period (%s)" % (window, period))
+        self.cpu = cpu
+        self.components = components
+        self.period = period
+        self.window = window
+        # [(instructions, {counter: delta})] per completed window.
+        self.windows = []
+        self._start = None
+        self._baseline = None
+        self._stopped = False
+    
+    def start(self):
+        '''
+            Safe from any thread, the first window is scheduled from the cpu thread.
+        '''
+        self.cpu.post(lambda cpu: cpu.schedule(cpu.icount + self.period - self.window, self._open_window))
+    
+    def stop(self):
+        '''
+            Closes the open window from the cpu thread, or from here once that thread is gone.
+            Returns when it is closed, the windows can be written out then.
+        '''
+        # The pending event is left to fire as a no-op.
+        self._stopped = True
+        closed = threading.Event()
+        def close(cpu):
+            self._close_window(cpu)
+            closed.set()
+        
+        thread = self.cpu.run_thread
+        if thread is None or thread is threading.current_thread():
+            close(self.cpu)
+            return
+        self.cpu.post(close)
+        while not closed.wait(STOP_POLL):
+            if not thread.is_alive():
+                # The cpu stopped before it got to it, closing twice is harmless.
+                close(self.cpu)
+    
+    def _counters(self):
+        counters = {}
+        for component in self.components:
+            if hasattr(component, 'counters'):
+                counters.update(component.counters())
+        return counters
+    
+    def _open_window(self, cpu):
+        if self._stopped:
+            return
+        for component in self.components:
+            component.enable()
+        self._start = cpu.icount
+        self._baseline = self._counters()
+        cpu.schedule(cpu.icount + self.window, self._close_window)
+    
+    def _close_window(self, cpu):
+        if self._start is None:
+            return
+        for component in self.components:
+            component.disable()
+        
+        counters = self._counters()
+        deltas = dict((name, count - self._baseline.get(name, 0)) for name, count in counters.items())
+        self.windows.append((cpu.icount - self._start, deltas))
+        self._start = None
+        if not self._stopped:
+            cpu.schedule(cpu.icount + self.period - self.window, self._open_window)
+    
+    def estimates(self, z=1.96):
+        '''
+            counter => (estimate, low, high) for the instructions executed so far.
+        '''
+        total = self.cpu.icount
+        names = set()
+        for _, deltas in self.windows:
+            names.update(deltas)
+        
+        estimates = {}
+        for name in names:
+            rates = [float(deltas.get(name, 0)) / instructions for instructions, deltas in self.windows if instructions]
+            if not rates:
+                continue
+            mean = sum(rates) / len(rates)
+            if len(rates) > 1:
+                variance = sum((rate - mean) ** 2 for rate in rates) / (len(rates) - 1)
+                margin = z * math.sqrt(variance / len(rates))
+            else:
+                margin = float('inf')
+            estimates[name] = (mean * total, max(mean - margin, 0) * total, (mean + margin) * total)
+        return estimates
+    
+    def report(self, top=20):
+        estimates = sorted([item for item in self.estimates().items() if item[1][0]], key=lambda item: item[1][0], reverse=True)
+        lines = ["%d windows over %d instructions" % (len(self.windows), self.cpu.icount)]
+        for name, (estimate, low, high) in estimates[:top]:
+            lines.append("%-20s %14.0f [%.0f, %.0f]" % (name, estimate, low, high))
+        return '\n'.join(lines)
+    
+    def write_json(self, path):
+        report = {
+                    'icount'    : self.cpu.icount,
+                    'windows'   : len(self.windows),
+                    'period'    : self.period,
+                    'window'    : self.window,
+                    # A single window has no upper bound.
+                    'estimates' : dict((name, {'estimate': estimate, 'low': low, 'high': None if math.isinf(high) else high})
+                                       for name, (estimate, low, high) in self.estimates().items())
+                 }
+        with open(path, 'w') as output:
+            json.dump(report, output, indent=4, sort_keys=True)
@@ -0,0 +1,80 @@
+'''
+    Statistical profiler of the guest pc.
+
+    Samples are taken every period instructions from an insn plugin of the cpu, or,
+    without a period, by a host thread that reads the pc every interval seconds and leaves
+    the cpu thread untouched.
+
+    Samples are aggregated per function with a SymbolTable and written in the collapsed stack
+    format read by flamegraph.pl:
+
+        reset;main 1200
+'''
+import time
+import threading
+
+class PCSampler(object):
+    def __init__(self, cpu, symbols=None, period=0, interval=0.001):
+        self.cpu = cpu
+        self.symbols = symbols
+        self.period = period
+        self.interval = interval
+        # pc => samples
+        self.samples = {}
+        self._stopped = False
+        self._thread = None
+        self._countdown = period
+    
+    def start(self):
+        if self.period:
+            self.cpu.register_plugin('insn', self._on_insn)
+        else:
+            self._thread = threading.Thread(target=self._timer_loop, name="PCSampler")
+            self._thread.daemon = True
+            self._thread.start()
+    
+    def stop(self):
+        if self._thread is not None:
+            self._stopped = True
+            self._thread.join()
+            self._thread = None
+        elif self.period:
+            self.cpu.unregister_plugin('insn', self._on_insn)
+    
+    def sample(self, pc):
+        self.samples[pc] = self.samples.get(pc, 0) + 1
+    
+    def _on_insn(self, cpu, pc, op):
+        self._countdown -= 1
+        if not self._countdown:
+            self._countdown = self.period
+            self.sample(pc)
+    
+    def _timer_loop(self):
+        while not self._stopped:
+            time.sleep(self.interval)
+            self.sample(self.cpu.ip.value)
+    
+    def functions(self):
+        '''
+            function name => samples, pcs without a symbol are kept as raw addresses.
+        '''
+        functions = {}
+        for pc, count in self.samples.items():
+            if self.symbols is not None:
+                name = self.symbols.name(pc)
+            else:
+                name = "0x%08x" % pc
+            functions[name] = functions.get(name, 0) + count
+        return functions
+    
+    def write_collapsed(self, path):
+        with open(path, 'w') as output:
+            for name, count in sorted(self.functions().items()):
+                output.write("%s %d\n" % (name, count))
+    
+    def report(self, top=20):
+        functions = sorted(self.functions().items(), key=lambda item: item[1], reverse=True)
+        total = sum(self.samples.values()) or 1
+        lines = ["%6.2f%% %8d %s" % (100.0 * count / total, count, name) for name, count in functions[:top]]
+        return '\n'.join(lines)
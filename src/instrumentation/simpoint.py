@@ -0,0 +1,205 @@
+'''
+    SimPoint style phase selection.
+
+    BBVRecorder writes a basic block vector every interval instructions in the SimPoint .bb
+    format, each block weighted by the instructions executed in it:
+
+        T:1:120 :2:4000 ...
+
+    Line n is interval n of cpu.icount counted from instruction 0, whenever the recorder was
+    attached. Intervals nothing executed in, before the recorder was attached or skipped by an
+    idle guest under virtual time, are empty lines.
+
+    choose_simpoints clusters the vectors with k-means and picks the interval closest to
+    every centroid, weighted by the share of the run its cluster covers:
+
+        python -m instrumentation.simpoint run.bb 10
+
+    writes run.simpoints and run.weights. A second run with an IntervalDumper then saves the
+    cpu state and the RAM at the start of the chosen intervals.
+'''
+import os
+import sys
+import json
+
+class BBVRecorder(object):
+    def __init__(self, cpu, path, interval=10000000):
+        self.cpu = cpu
+        self.interval = interval
+        self.intervals = 0
+        # block leader address => SimPoint block id, ids start from 1.
+        self.block_ids = {}
+        self._vector = {}
+        self._leader = None
+        self._next_pc = None
+        # icount the current interval ends at.
+        self._end = interval
+        self._file = open(path, 'w')
+    
+    def attach(self):
+        # Intervals are counted from instruction 0 like those of IntervalDumper: the ones
+        # already run get an empty vector and the current one is cut short.
+        self._skip(self.cpu.icount)
+        self.cpu.register_plugin('insn', self._on_insn)
+    
+    def detach(self):
+        self.cpu.unregister_plugin('insn', self._on_insn)
+    
+    def _on_insn(self, cpu, pc, op):
+        # icount is the number of instructions executed before this one.
+        if cpu.icount >= self._end:
+            self._emit()
+            self._skip(cpu.icount)
+        
+        if pc != self._next_pc:
+            self._leader = pc
+        self._next_pc = pc + 4
+        self._vector[self._leader] = self._vector.get(self._leader, 0) + 1
+    
+    def _skip(self, icount):
+        # Empty vectors up to the interval icount is in.
+        while icount >= self._end:
+            self._file.write("T\n")
+            self.intervals += 1
+            self._end += self.interval
+    
+    def _emit(self):
+        entries = []
+        for leader, count in sorted(self._vector.items()):
+            block_id = self.block_ids.get(leader)
+            if block_id is None:
+                block_id = self.block_ids[leader] = len(self.block_ids) + 1
+            entries.append(":%d:%d" % (block_id, count))
+        
+        self._file.write("T%s\n" % ' '.join(entries))
+        self.intervals += 1
+        self._end += self.interval
+        self._vector = {}
+    
+    def close(self):
+        # A trailing partial interval isn't representative, drop it.
+        if self.cpu.icount >= self._end:
+            self._emit()
+        self._file.close()
+
+def load_bbv(path):
+    '''
+        [{block id: instructions}] per interval.
+    '''
+    vectors = []
+    with open(path) as bbv:
+        for line in bbv:
+            if not line.startswith('T'):
+                continue
+            vector = {}
+            for entry in line[1:].split():
+                _, block_id, count = entry.split(':')
+                vector[int(block_id)] = int(count)
+            vectors.append(vector)
+    return vectors
+
+def kmeans(points, k, iterations=100, seed=0):
+    import numpy
+    
+    random = numpy.random.RandomState(seed)
+    centroids = points[random.choice(len(points), k, replace=False)]
+    for _ in range(iterations):
+        distances = ((points[:, numpy.newaxis, :] - centroids[numpy.newaxis, :, :]) ** 2).sum(axis=2)
+        labels = distances.argmin(axis=1)
+        updated = numpy.array([points[labels == cluster].mean(axis=0) if (labels == cluster).any() else centroids[cluster]
+                               for cluster in range(k)])
+        if numpy.allclose(updated, centroids):
+            break
+        centroids = updated
+    return labels, centroids
+
+def choose_simpoints(vectors, k, dimensions=15, seed=0):
+    '''
+        [(interval, weight)], one per non empty cluster. Like SimPoint the normalised vectors
+        are randomly projected down to a few dimensions before clustering.
+    '''
+    # Empty vectors are the intervals run before the recorder was attached or idle.
+    recorded = [index for index, vector in enumerate(vectors) if vector]
+    if not recorded:
+        # E.g. a run shorter than one interval.
+        return []
+    
+    import numpy
+    blocks = max(max(vectors[index]) for index in recorded)
+    matrix = numpy.zeros((len(recorded), blocks))
+    for row, index in enumerate(recorded):
+        for block_id, count in vectors[index].items():
+            matrix[row, block_id - 1] = count
+    matrix /= numpy.maximum(matrix.sum(axis=1), 1)[:, numpy.newaxis]
+    
+    projection = numpy.random.RandomState(seed).uniform(-1, 1, (blocks, dimensions))
+    points = matrix.dot(projection)
+    
+    k = min(k, len(recorded))
+    labels, centroids = kmeans(points, k, seed=seed)
+    
+    simpoints = []
+    for cluster in range(k):
+        members = numpy.flatnonzero(labels == cluster)
+        if not len(members):
+            continue
+        distances = ((points[members] - centroids[cluster]) ** 2).sum(axis=1)
+        simpoints.append((recorded[members[distances.argmin()]], float(len(members)) / len(recorded)))
+    return sorted(simpoints)
+
+def write_simpoints(prefix, simpoints):
+    with open(prefix + '.simpoints', 'w') as points:
+        with open(prefix + '.weights', 'w') as weights:
+            for cluster, (interval, weight) in enumerate(simpoints):
+                points.write("%d %d\n" % (interval, cluster))
+                weights.write("%f %d\n" % (weight, cluster))
+
+def load_simpoints(path):
+    with open(path) as points:
+        return sorted(int(line.split()[0]) for line in points if line.strip())
+
+class IntervalDumper(object):
+    '''
+        Saves the cpu state (state.json) and the images of memories, {name: memory}, into
+        directory/interval_<n> when the run reaches the start of one of intervals.
+    '''
+    def __init__(self, cpu, memories, intervals, interval_length, directory):
+        self.cpu = cpu
+        self.memories = memories
+        self.interval_length = interval_length
+        self.directory = directory
+        self._pending = sorted(intervals)
+    
+    def attach(self):
+        self.cpu.register_plugin('insn', self._on_insn)
+    
+    def detach(self):
+        self.cpu.unregister_plugin('insn', self._on_insn)
+    
+    def _on_insn(self, cpu, pc, op):
+        # icount is the number of instructions executed before this one.
+        if not self._pending or cpu.icount < self._pending[0] * self.interval_length:
+            return
+        
+        self.dump(self._pending.pop(0))
+        if not self._pending:
+            self.detach()
+    
+    def dump(self, interval):
+        directory = os.path.join(self.directory, "interval_%d" % interval)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        
+        with open(os.path.join(directory, 'state.json'), 'w') as state:
+            json.dump(self.cpu.get_state(), state, indent=4, sort_keys=True)
+        
+        for name, memory in self.memories.items():
+            with open(os.path.join(directory, name + '.bin'), 'wb') as image:
+                image.write(memory.image())
+
+if __name__ == "__main__":
+    bbv_path = sys.argv[1]
+    simpoints = choose_simpoints(load_bbv(bbv_path), int(sys.argv[2]))
+    write_simpoints(os.path.splitext(bbv_path)[0], simpoints)
+    for interval, weight in simpoints:
+        print("interval %d weight %.4f" % (interval, weight))
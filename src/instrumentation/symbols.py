@@ -0,0 +1,125 @@
+'''
+    Guest symbol tables, loaded from an ELF image or from an nm style map file:
+
+        arm-none-eabi-nm -n output.elf > output.map
+'''
+import bisect
+import struct
+
+ELF_MAGIC = '\x7fELF'
+
+ELF32_HEADER = struct.Struct('<16sHHIIIIIHHHHHH')
+ELF32_SECTION = struct.Struct('<IIIIIIIIII')
+ELF32_SYMBOL = struct.Struct('<IIIBBH')
+
+SHT_SYMTAB  = 2
+STT_NOTYPE  = 0
+STT_FUNC    = 2
+
+class InvalidSymbolFile(Exception):
+    def __init__(self, path):
+        Exception.__init__(self)
+        self.path = path
+
+class SymbolTable(object):
+    '''
+        A symbol covers [address, address + size), or up to the next symbol when its size
+        isn't known.
+    '''
+    def __init__(self, symbols=()):
+        symbols = sorted(symbols)
+        self._starts = [address for address, _, _ in symbols]
+        self._symbols = symbols
+    
+    def __len__(self):
+        return len(self._symbols)
+    
+    def lookup(self, address):
+        '''
+            Returns (name, offset) of the symbol covering address, None if there isn't any.
+        '''
+        index = bisect.bisect_right(self._starts, address) - 1
+        if index < 0:
+            return None
+        
+        start, size, name = self._symbols[index]
+        if size and address >= start + size:
+            return None
+        return name, address - start
+    
+    def name(self, address):
+        '''
+            Symbol name of address, the raw address when no symbol covers it.
+        '''
+        symbol = self.lookup(address)
+        if symbol is None:
+            return "0x%08x" % address
+        return symbol[0]
+    
+    def functions(self):
+        '''
+            [(address, size, name)] sorted by address, size is 0 when unknown.
+        '''
+        return list(self._symbols)
+    
+    def address(self, name):
+        for start, _, symbol in self._symbols:
+            if symbol == name:
+                return start
+        return None
+
+def load_elf(path):
+    with open(path, 'rb') as elf:
+        image = elf.read()
+    
+    if image[:4] != ELF_MAGIC or ord(image[4]) != 1 or ord(image[5]) != 1:
+        # Only 32-bit little endian images.
+        raise InvalidSymbolFile(path)
+    
+    header = ELF32_HEADER.unpack_from(image)
+    shoff, shentsize, shnum = header[6], header[11], header[12]
+    sections = [ELF32_SECTION.unpack_from(image, shoff + index * shentsize) for index in range(shnum)]
+    
+    symbols = []
+    for section in sections:
+        if section[1] != SHT_SYMTAB:
+            continue
+        
+        strtab = sections[section[6]]
+        strings = image[strtab[4]:strtab[4] + strtab[5]]
+        for offset in range(section[4], section[4] + section[5], section[9]):
+            st_name, st_value, st_size, st_info, _, st_shndx = ELF32_SYMBOL.unpack_from(image, offset)
+            if st_info & 0xF not in (STT_FUNC, STT_NOTYPE) or not st_shndx or not st_name:
+                continue
+            
+            name = strings[st_name:strings.index('\0', st_name)]
+            # $a, $d and $t are ARM mapping symbols, not code labels.
+            if name.startswith('$'):
+                continue
+            # Thumb functions have bit 0 set.
+            symbols.append((st_value & ~1, st_size, name))
+    
+    return SymbolTable(symbols)
+
+def load_map(path):
+    symbols = []
+    with open(path) as map_file:
+        for line in map_file:
+            fields = line.split()
+            if len(fields) != 3 or fields[1] not in 'TtWw':
+                continue
+            try:
+                address = int(fields[0], 16)
+            except ValueError:
+                continue
+            symbols.append((address, 0, fields[2]))
+    
+    return SymbolTable(symbols)
+
+def load(path):
+    with open(path, 'rb') as symbol_file:
+        magic = symbol_file.read(4)
+    
+    if magic == ELF_MAGIC:
+        return load_elf(path)
+    return load_map(path)
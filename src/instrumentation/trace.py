@@ -0,0 +1,213 @@
+'''
+    Trace points for the simulator hot paths.
+
+    Every trace point is guarded by a single boolean attribute of the tracer, so a disabled
+    category costs one attribute check. Enabled categories emit fixed-size binary records
+    (category, address, value, pc) to a sink, use decode() or run this module to read them back:
+
+        python -m instrumentation.trace trace.bin.gz
+'''
+import sys
+import gzip
+import time
+import struct
+import logging
+import threading
+
+FETCH       = 0x1
+MEM_READ    = 0x2
+MEM_WRITE   = 0x3
+PROXY_READ  = 0x4
+PROXY_WRITE = 0x5
+
+# name => categories it turns on.
+CATEGORIES = {
+                'fetch'     : (FETCH,),
+                'mem_read'  : (MEM_READ,),
+                'mem_write' : (MEM_WRITE,),
+                'mem'       : (MEM_READ, MEM_WRITE),
+                'proxy'     : (PROXY_READ, PROXY_WRITE),
+                'all'       : (FETCH, MEM_READ, MEM_WRITE, PROXY_READ, PROXY_WRITE)
+             }
+
+CATEGORY_NAMES = {
+                FETCH       : 'fetch',
+                MEM_READ    : 'mem_read',
+                MEM_WRITE   : 'mem_write',
+                PROXY_READ  : 'proxy_read',
+                PROXY_WRITE : 'proxy_write'
+             }
+
+# category, address, value, pc
+RECORD = struct.Struct('<BxxxIII')
+
+class UnknownTraceCategory(Exception):
+    def __init__(self, name):
+        Exception.__init__(self)
+        self.name = name
+
+def open_trace(path, mode='rb'):
+    '''
+        Trace files ending with .gz are gzip compressed.
+    '''
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+class FileSink(object):
+    '''
+        Writes every record synchronously from the calling thread.
+    '''
+    def __init__(self, path):
+        self.file = open_trace(path, 'wb')
+    
+    def record(self, category, address, value, pc):
+        self.file.write(RECORD.pack(category, address, value, pc))
+    
+    def close(self):
+        self.file.close()
+
+class AsyncSink(object):
+    '''
+        Packs records into a preallocated ring buffer and leaves the file writes (and the
+        compression) to a background writer thread.
+        
+        The producer thread (the cpu thread) is the only one moving head and the writer the
+        only one moving tail, so neither takes a lock. When the ring is full the record is
+        dropped and counted in overflows instead of waiting for the writer. Records from other
+        threads, e.g. guest memory read by the gdb stub, are dropped too and counted in foreign.
+        The producer is the first thread to record unless set beforehand.
+    '''
+    def __init__(self, path, capacity=1 << 16, interval=0.01, producer=None):
+        self.logger = logging.getLogger("AsyncSink")
+        self.path = path
+        self.capacity = capacity
+        self.interval = interval
+        self._ring = bytearray(capacity * RECORD.size)
+        # Records produced and consumed so far, slot = count % capacity.
+        self.head = 0
+        self.tail = 0
+        self.overflows = 0
+        # A threading.Thread.
+        self.producer = producer
+        self.foreign = 0
+        self._file = open_trace(path, 'wb')
+        self._stopped = False
+        self._writer = threading.Thread(target=self._drain_loop, name="AsyncSink")
+        self._writer.daemon = True
+        self._writer.start()
+    
+    def record(self, category, address, value, pc):
+        thread = threading.current_thread()
+        if thread is not self.producer:
+            if self.producer is not None:
+                self.foreign += 1
+                return
+            self.producer = thread
+        
+        head = self.head
+        if head - self.tail >= self.capacity:
+            self.overflows += 1
+            return
+        RECORD.pack_into(self._ring, (head % self.capacity) * RECORD.size, category, address, value, pc)
+        self.head = head + 1
+    
+    def _drain(self):
+        tail = self.tail
+        head = self.head
+        if head == tail:
+            return
+        
+        size = RECORD.size
+        first = (tail % self.capacity) * size
+        last = (head % self.capacity) * size
+        if first < last:
+            self._file.write(bytes(self._ring[first:last]))
+        else:
+            # Wrapped around the end of the ring.
+            self._file.write(bytes(self._ring[first:]))
+            self._file.write(bytes(self._ring[:last]))
+        self.tail = head
+    
+    def _drain_loop(self):
+        while not self._stopped:
+            self._drain()
+            time.sleep(self.interval)
+    
+    def close(self):
+        self._stopped = True
+        self._writer.join()
+        self._drain()
+        self._file.close()
+        if self.overflows:
+            self.logger.warning("Dropped (%s) trace records, the ring buffer was full", self.overflows)
+        if self.foreign:
+            self.logger.warning("Dropped (%s) trace records from other threads than (%s)", self.foreign, self.producer.name)
+
+class Tracer(object):
+    def __init__(self):
+        self.sink = None
+        # pc of the instruction being executed, kept up to date by the cpu while tracing.
+        self.pc = 0
+        self.set_categories(())
+    
+    def set_categories(self, names):
+        '''
+            names is a comma separated string or a list of names from CATEGORIES,
+            an empty one turns tracing off.
+        '''
+        if isinstance(names, str):
+            names = [name.strip() for name in names.split(',') if name.strip()]
+        
+        enabled = set()
+        for name in names:
+            try:
+                enabled.update(CATEGORIES[name])
+            except KeyError:
+                raise UnknownTraceCategory(name)
+        
+        # The flags tested by the trace points.
+        self.fetch = FETCH in enabled
+        self.mem_read = MEM_READ in enabled
+        self.mem_write = MEM_WRITE in enabled
+        self.proxy = PROXY_READ in enabled
+        self.enabled = bool(enabled) and self.sink is not None
+        self._categories = enabled
+    
+    def set_sink(self, sink):
+        self.sink = sink
+        self.enabled = bool(self._categories) and sink is not None
+    
+    def record(self, category, address, value):
+        if self.sink is not None:
+            self.sink.record(category, address & 0xFFFFFFFF, value & 0xFFFFFFFF, self.pc & 0xFFFFFFFF)
+    
+    def close(self):
+        if self.sink is not None:
+            self.sink.close()
+            self.set_sink(None)
+
+# The process wide tracer all the trace points report to.
+tracer = Tracer()
+
+def decode(stream):
+    '''
+        Yields (category, address, value, pc) for every record in stream.
+    '''
+    size = RECORD.size
+    while True:
+        data = stream.read(size)
+        if len(data) < size:
+            break
+        yield RECORD.unpack(data)
+
+def format_record(category, address, value, pc):
+    return "pc=%08x %-11s address=%08x value=%08x" % (pc, CATEGORY_NAMES.get(category, category), address, value)
+
+if __name__ == "__main__":
+    stream = open_trace(sys.argv[1])
+    try:
+        for record in decode(stream):
+            print(format_record(*record))
+    finally:
+        stream.close()
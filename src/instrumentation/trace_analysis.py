@@ -0,0 +1,57 @@
+'''
+    Queries over the execution traces written by instrumentation.exec_trace.
+
+    Traces are memory mapped as numpy structured arrays (see exec_trace.DESCR), so multi-GB
+    traces don't have to fit in memory:
+
+        trace = load("boot.npy")
+        last_writer(trace, 0x4030d000)
+'''
+import sys
+import numpy
+
+from instrumentation.exec_trace import MEM_WRITE
+
+def load(path):
+    return numpy.load(path, mmap_mode='r')
+
+def last_writer(trace, address, before=None):
+    '''
+        The last record that wrote the word containing address, optionally only looking
+        at the instructions before icount before. Returns None if nothing wrote it.
+    '''
+    writes = (trace['flags'] & MEM_WRITE) != 0
+    writes &= (trace['mem_addr'] & 0xFFFFFFFC) == (address & 0xFFFFFFFC)
+    if before is not None:
+        writes &= trace['icount'] < before
+    
+    hits = numpy.flatnonzero(writes)
+    if not len(hits):
+        return None
+    return trace[hits[-1]]
+
+def pc_histogram(trace, top=None):
+    '''
+        [(pc, executions)] sorted by the number of executions.
+    '''
+    pcs, counts = numpy.unique(trace['pc'], return_counts=True)
+    order = numpy.argsort(counts)[::-1]
+    if top is not None:
+        order = order[:top]
+    return [(int(pcs[i]), int(counts[i])) for i in order]
+
+def branch_targets(trace):
+    '''
+        The set of (source pc, target pc) of every taken branch, i.e. every time the next
+        executed instruction isn't the following word.
+    '''
+    pcs = trace['pc']
+    taken = numpy.flatnonzero(pcs[1:] != pcs[:-1] + 4)
+    pairs = numpy.unique(numpy.stack((pcs[taken], pcs[taken + 1]), axis=1), axis=0)
+    return set((int(source), int(target)) for source, target in pairs)
+
+if __name__ == "__main__":
+    trace = load(sys.argv[1])
+    print("%d records" % len(trace))
+    for pc, count in pc_histogram(trace, top=20):
+        print("%08x %d" % (pc, count))
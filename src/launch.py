@@ -1,11 +1,25 @@
 import sys
 import time
+import threading
 import signal
 import logging
 import soc.omap4
 import global_env
 from gdb.gdbstub import GDBStubServer
 from host_frontends.char_device import CharDevice
+from soc.page_store import PageStore
+from soc.checkpoints import CheckpointRing
+from host_frontends.fork_server import ForkServer
+from host_frontends.replay import EventRecorder, EventReplayer
+from instrumentation.trace import tracer, AsyncSink
+from instrumentation.exec_trace import ExecutionRecorder
+from instrumentation.sampler import PCSampler
+from instrumentation.callgraph import CallGraphProfiler
+from instrumentation.opstats import OpcodeStatistics
+from instrumentation import coverage
+from instrumentation import simpoint
+from instrumentation.sampled import SampledDetailedMode, TraceWindow
+from instrumentation import symbols
 
 logger = logging.getLogger("Launcher")
 
@@ -19,21 +33,143 @@ if __name__ == "__main__":
     logging.addLevelName(logging.CRITICAL, "\033[1;41m%s\033[1;m" % logging.getLevelName(logging.CRITICAL))
 
     os_path = ""
+    gdb_port = 0
+    trace_categories = ""
+    trace_path = "trace.bin.gz"
+    symbols_path = ""
+    profile_path = ""
+    profile_period = 0
+    callgraph_path = ""
+    opstats_path = ""
+    coverage_path = ""
+    exec_trace_path = ""
+    bbv_path = ""
+    bbv_interval = 10000000
+    simpoints_path = ""
+    simpoint_dir = "simpoints"
+    sampled_path = ""
+    sample_period = 1000000
+    sample_window = 10000
+    restore_path = ""
+    snapshot_path = ""
+    snapshot_at = 0
+    snapshot_store = ""
+    fork_server = False
+    boot_pc = None
+    boot_icount = None
+    input_address = None
+    input_length_address = None
+    exit_pc = None
+    max_instructions = 1000000
+    testcase_timeout = 0
+    record_path = ""
+    replay_path = ""
+    checkpoint_interval = 0
+    checkpoint_capacity = 16
+    virtual_time = False
+    idle_detection = True
 
     try:
         index = 0
         for arg in sys.argv[1:]:
             if arg == '-s':
-                global_env.dbg_event.clear()
-                global_env.STEPPING = True
+                global_env.context.dbg_event.clear()
+                global_env.context.STEPPING = True
             elif arg == '-p':
                 os_path = sys.argv[index+2]
             elif arg == '-gdb':
                 gdb_port = int(sys.argv[index+2])
+            elif arg == '-trace':
+                trace_categories = sys.argv[index+2]
+            elif arg == '-trace-file':
+                trace_path = sys.argv[index+2]
+            elif arg == '-symbols':
+                symbols_path = sys.argv[index+2]
+            elif arg == '-profile':
+                profile_path = sys.argv[index+2]
+            elif arg == '-profile-period':
+                profile_period = int(sys.argv[index+2])
+            elif arg == '-callgraph':
+                callgraph_path = sys.argv[index+2]
+            elif arg == '-opstats':
+                opstats_path = sys.argv[index+2]
+            elif arg == '-coverage':
+                coverage_path = sys.argv[index+2]
+            elif arg == '-exec-trace':
+                exec_trace_path = sys.argv[index+2]
+            elif arg == '-bbv':
+                bbv_path = sys.argv[index+2]
+            elif arg == '-bbv-interval':
+                bbv_interval = int(sys.argv[index+2])
+            elif arg == '-simpoints':
+                simpoints_path = sys.argv[index+2]
+            elif arg == '-simpoint-dir':
+                simpoint_dir = sys.argv[index+2]
+            elif arg == '-sampled':
+                sampled_path = sys.argv[index+2]
+            elif arg == '-sample-period':
+                sample_period = int(sys.argv[index+2])
+            elif arg == '-sample-window':
+                sample_window = int(sys.argv[index+2])
+            elif arg == '-restore':
+                restore_path = sys.argv[index+2]
+            elif arg == '-snapshot':
+                snapshot_path = sys.argv[index+2]
+            elif arg == '-snapshot-at':
+                snapshot_at = int(sys.argv[index+2])
+            elif arg == '-snapshot-store':
+                snapshot_store = sys.argv[index+2]
+            elif arg == '-fork-server':
+                fork_server = True
+            elif arg == '-boot-pc':
+                boot_pc = int(sys.argv[index+2], 0)
+            elif arg == '-boot-icount':
+                boot_icount = int(sys.argv[index+2])
+            elif arg == '-input-address':
+                input_address = int(sys.argv[index+2], 0)
+            elif arg == '-input-length-address':
+                input_length_address = int(sys.argv[index+2], 0)
+            elif arg == '-exit-pc':
+                exit_pc = int(sys.argv[index+2], 0)
+            elif arg == '-max-instructions':
+                max_instructions = int(sys.argv[index+2])
+            elif arg == '-testcase-timeout':
+                testcase_timeout = int(sys.argv[index+2])
+            elif arg == '-record':
+                record_path = sys.argv[index+2]
+            elif arg == '-replay':
+                replay_path = sys.argv[index+2]
+            elif arg == '-checkpoint-interval':
+                checkpoint_interval = int(sys.argv[index+2])
+            elif arg == '-checkpoints':
+                checkpoint_capacity = int(sys.argv[index+2])
+            elif arg == '-virtual-time':
+                virtual_time = True
+            elif arg == '-no-idle':
+                idle_detection = False
             index += 1
     except:
         pass
     
+    if fork_server:
+        # Without them the fork server would boot forever or run testcases it can't feed.
+        if boot_pc is None and boot_icount is None:
+            logger.critical("-fork-server needs -boot-pc or -boot-icount")
+            sys.exit(2)
+        if input_address is None or exit_pc is None:
+            logger.critical("-fork-server needs -input-address and -exit-pc")
+            sys.exit(2)
+    
+    if checkpoint_interval and (snapshot_store or snapshot_path):
+        # Both take over the dirty bits of the memories, each would miss the pages the
+        # other cleared.
+        logger.critical("-checkpoint-interval can't be combined with -snapshot or -snapshot-store")
+        sys.exit(2)
+    
+    if sampled_path and sample_window > sample_period:
+        logger.critical("-sample-window can't be longer than -sample-period")
+        sys.exit(2)
+    
     if not os_path:
         os_path = "../examples/tinyos/output.bin"
         logger.warning("Using default OS located at (%s)", os_path)
@@ -44,17 +180,133 @@ if __name__ == "__main__":
         logger.warning("Using default gdb port (20005)")
         gdb_port = 20005
     
+    if trace_categories:
+        # e.g. -trace fetch,mem, with -sampled only inside the detailed windows.
+        if not sampled_path:
+            tracer.set_categories(trace_categories)
+        tracer.set_sink(AsyncSink(trace_path))
+        logger.warning("Tracing (%s) to (%s)", trace_categories, trace_path)
+    
     #signal.signal(signal.SIGINT, shutdown)
     #signal.signal(signal.SIGTERM, shutdown)
-    main_thing =  soc.omap4.OMAP4()
-    global_env.soc = main_thing
+    # Registers itself as the soc of global_env.context.
+    main_thing =  soc.omap4.OMAP4(restore_path or None)
+    if trace_categories:
+        # cpu0 runs in the OMAP4 thread, or in this one for the fork server. What the gdb
+        # stub or the image loader access from elsewhere isn't traced.
+        tracer.sink.producer = threading.current_thread() if fork_server else main_thing
+    if snapshot_store:
+        # -snapshot and -restore then name snapshots in the store.
+        main_thing.snapshot_store = PageStore(snapshot_store)
+    
+    if record_path:
+        main_thing.event_log = EventRecorder(record_path)
+        global_env.context.stop_callbacks.append(main_thing.event_log.close)
+        logger.warning("Recording asynchronous events to (%s)", record_path)
+    elif replay_path:
+        main_thing.event_log = EventReplayer(replay_path)
+        logger.warning("Replaying asynchronous events from (%s)", replay_path)
+    
+    if fork_server:
+        # Boot once in this thread, then fork a child per testcase path read from stdin.
+        main_thing.prepare()
+        server = ForkServer(main_thing.mpu.cpu0, input_address, exit_pc, max_instructions, testcase_timeout, input_length_address)
+        server.boot(boot_pc, boot_icount)
+        logger.warning("Fork server ready after (%s) instructions", main_thing.mpu.cpu0.icount)
+        server.serve()
+        sys.exit(0)
+    
+    # cpu0 exists from here on but only runs once booted, what is attached in between sees
+    # the whole boot.
+    main_thing.prepare()
+    
+    if global_env.context.main_cpu:
+        # An idle guest fast-forwards to the next scheduled event instead of spinning.
+        global_env.context.main_cpu.virtual_time = virtual_time
+        global_env.context.main_cpu.idle_detection = idle_detection
+    
+    symbol_table = symbols.load(symbols_path) if symbols_path else None
+    if profile_path and global_env.context.main_cpu:
+        # Without a period the pc is sampled from a host timer.
+        sampler = PCSampler(global_env.context.main_cpu, symbol_table, profile_period)
+        sampler.start()
+        global_env.context.stop_callbacks.append(lambda: sampler.write_collapsed(profile_path))
+        logger.warning("Profiling the guest to (%s)", profile_path)
+    
+    if callgraph_path and global_env.context.main_cpu:
+        profiler = CallGraphProfiler(global_env.context.main_cpu, symbol_table)
+        profiler.attach()
+        global_env.context.stop_callbacks.append(lambda: profiler.write_collapsed(callgraph_path))
+        logger.warning("Recording the guest call graph to (%s)", callgraph_path)
+    
+    if coverage_path and global_env.context.main_cpu:
+        guest_coverage = coverage.Coverage(global_env.context.main_cpu, block_counts=True)
+        guest_coverage.attach()
+        def write_coverage():
+            if coverage_path.endswith('.info') and symbol_table is not None:
+                # lcov needs the line tables of the ELF image given with -symbols.
+                addresses = coverage.code_addresses(symbol_table)
+                line_map = coverage.addr2line_map(symbols_path, addresses)
+                guest_coverage.write_lcov(coverage_path, line_map, symbol_table, addresses)
+            else:
+                guest_coverage.write_json(coverage_path)
+        global_env.context.stop_callbacks.append(write_coverage)
+    
+    if exec_trace_path and global_env.context.main_cpu:
+        # A numpy .npy file, see instrumentation.trace_analysis.
+        exec_recorder = ExecutionRecorder(exec_trace_path)
+        exec_recorder.attach(global_env.context.main_cpu)
+        global_env.context.stop_callbacks.append(exec_recorder.close)
+        logger.warning("Recording the executed instructions to (%s)", exec_trace_path)
+    
+    if bbv_path and global_env.context.main_cpu:
+        bbv_recorder = simpoint.BBVRecorder(global_env.context.main_cpu, bbv_path, bbv_interval)
+        bbv_recorder.attach()
+        global_env.context.stop_callbacks.append(bbv_recorder.close)
+    
+    if opstats_path and global_env.context.main_cpu:
+        opstats = OpcodeStatistics(global_env.context.main_cpu)
+        opstats.enable()
+        global_env.context.stop_callbacks.append(lambda: opstats.write_json(opstats_path))
+    
     main_thing.boot()
     time.sleep(0.5)
     
+    if snapshot_path and global_env.context.main_cpu:
+        # Taken from cpu0's own thread, between two instructions. Its event queue is only
+        # touched from there too.
+        global_env.context.main_cpu.post(lambda cpu: cpu.schedule(snapshot_at, lambda cpu: main_thing.save_snapshot(snapshot_path)))
+        logger.warning("Snapshotting to (%s) at instruction (%s)", snapshot_path, snapshot_at)
+    
+    if sampled_path and global_env.context.main_cpu:
+        # Shares the counters of -opstats, its windows then only nest in the enabled run.
+        components = [global_env.context.main_cpu.opstats or OpcodeStatistics(global_env.context.main_cpu)]
+        if trace_categories:
+            components.append(TraceWindow(trace_categories))
+        sampled = SampledDetailedMode(global_env.context.main_cpu, components, sample_period, sample_window)
+        sampled.start()
+        def write_sampled():
+            sampled.stop()
+            sampled.write_json(sampled_path)
+        global_env.context.stop_callbacks.append(write_sampled)
+    
+    if simpoints_path and global_env.context.main_cpu:
+        # Dump the intervals picked by a previous -bbv run, same -bbv-interval.
+        intervals = simpoint.load_simpoints(simpoints_path)
+        dumper = simpoint.IntervalDumper(global_env.context.main_cpu, main_thing.memories(), intervals, bbv_interval, simpoint_dir)
+        dumper.attach()
+    
+    if checkpoint_interval and global_env.context.main_cpu:
+        # Lets gdb reverse-step and reverse-continue over the last checkpoints.
+        checkpoints = CheckpointRing(global_env.context.main_cpu, main_thing.memories(), main_thing.devices(), checkpoint_interval, checkpoint_capacity)
+        checkpoints.attach()
+        global_env.context.checkpoints = checkpoints
+        logger.warning("Checkpointing every (%s) instructions", checkpoint_interval)
+    
     char_dev = CharDevice(port=gdb_port)
-    global_env.char_devices.append(char_dev)
+    global_env.context.char_devices.append(char_dev)
     logger.critical("Waiting for gdb connection on port (%s)", gdb_port)
     char_dev.connect()
     gdb_server = GDBStubServer(char_dev)
-    global_env.dbg = gdb_server
+    global_env.context.dbg = gdb_server
     gdb_server.start()
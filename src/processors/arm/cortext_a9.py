@@ -3,12 +3,19 @@ import threading
 import global_env
 from ctypes import c_uint32, c_uint64, c_int32, c_int64
 from controllers.interfaces import AbstractInterruptConsumer
+from instrumentation.trace import tracer, FETCH
+import heapq
 import sys
 
 INITIAL_IP = c_uint32(0x0)
 CPSR_RESET = c_uint32(0x0)
 MIDR_RESET = c_uint32(0x412FC092)
 
+# icount of an empty event queue.
+NO_EVENT = 1 << 63
+# Seconds between the checks of an idle cpu for the debugger and stop().
+IDLE_POLL = 0.1
+
 class NotImplementedInstructionSet(Exception):
     pass
 
@@ -27,6 +34,9 @@ class WrongExecutionFlow(Exception):
 class Unpredictable(Exception):
     pass
 
+class UnknownPluginEvent(Exception):
+    pass
+
 class AccessViolation(Exception):
     pass
 
@@ -160,6 +170,17 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
     STR_IMMEDIATE_RT_SHIFT  = 12
     STR_IMMEDIATE_IMM       = 0x00000FFF
     
+    STRB_IMMEDIATE_OP_MASK  = 0x0E500000
+    STRB_IMMEDIATE_OP       = 0x04400000
+    STRB_IMMEDIATE_P        = 0x01000000
+    STRB_IMMEDIATE_U        = 0x00800000
+    STRB_IMMEDIATE_W        = 0x00200000
+    STRB_IMMEDIATE_RN       = 0x000F0000
+    STRB_IMMEDIATE_RN_SHIFT = 16
+    STRB_IMMEDIATE_RT       = 0x0000F000
+    STRB_IMMEDIATE_RT_SHIFT = 12
+    STRB_IMMEDIATE_IMM      = 0x00000FFF
+    
     # Branch
     B_OP_MASK               = 0x0F000000
     B_OP                    = 0x0A000000
@@ -469,6 +490,13 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
     MSR_REGISTER_RN         = 0x0000000F
     MSR_REGISTER_R          = 0x00400000
     
+    # Hints (NOP, YIELD, WFE, WFI, SEV)
+    HINT_OP_MASK            = 0x0FFFFF00
+    HINT_OP                 = 0x0320F000
+    HINT_OPTION             = 0x000000FF
+    HINT_WFE                = 0x02
+    HINT_WFI                = 0x03
+    
     # PUSH
     PUSH_OP1_MASK           = 0x0FFF0000
     PUSH_OP1                = 0x092D0000
@@ -489,16 +517,40 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
     POP_OP2_RT_SHIFT        = 12
     
 
-    def __init__(self, name, system_bus, security_extensions=True):
+    def __init__(self, name, system_bus, security_extensions=True, context=None):
         threading.Thread.__init__(self)
+        # A soc.context.MachineContext, the debugger state lives there.
+        self.context = context if context is not None else global_env.context
         # A word is 4-bytes long.
         self.logger = logging.getLogger(name)
         self.name = name
         self.system_bus = system_bus
+        # All our accesses go through this port, the bus bank is our name.
+        self.bus_port = system_bus.get_port(name)
         self.word_size = 4
         self.received_interrupts = {}
-        global_env.THREAD_ENV.engine_id = name
         self.HaveSecurityExt = security_extensions
+        # Instructions executed so far, including the ones that failed their condition and
+        # the idle spins skipped under virtual time.
+        self.icount = 0
+        # event => [(callback, start, end)], see register_plugin.
+        self._plugins = {}
+        # Set by instrumentation.opstats while it counts the op handlers.
+        self.opstats = None
+        # [(icount, sequence, callback)] heap, see schedule.
+        self._events = []
+        self._event_sequence = 0
+        self._next_event = NO_EVENT
+        # Callbacks handed over by other threads, see post.
+        self._posted = []
+        # The thread executing our instructions, set by run.
+        self.run_thread = None
+        # See _Idle.
+        self.idle_detection = True
+        self.virtual_time = False
+        # Of icount, the instructions skipped that way.
+        self.idle_skipped = 0
+        self._idle_condition = threading.Condition()
         
         self.init_registers()
         self.init_interrupts()
@@ -530,7 +582,7 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
             table_index = vaddress & ((12 - n) << 20)
             tbi = translation_base + (table_index << 2)
             
-        pdte = self.system_bus.read(tbi).value # page directory table entry
+        pdte = self.bus_port.read(tbi) # page directory table entry
         pdte_type = pdte & self.PAGEDIR_TYPE_MASK # page directoy table entry type
         
         pte = None
@@ -548,7 +600,7 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
             l2ti = vaddress & (0xFF << 12)
             tbi = ptba | (l2ti << 2)
             # level 2 descriptor
-            pte = self.system_bus.read(tbi).value
+            pte = self.bus_port.read(tbi)
             if pte & 0x2:
                 # small page
                 # XN
@@ -638,7 +690,7 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
         # If we're here then we passed all the checks.
         return paddress
 
-    def mmu_read(self, vaddress, instruction=False):
+    def mmu_read(self, vaddress, instruction=False, size=4):
         fs = None
         try:
             paddress = self._mmu_translate(vaddress, instruction=instruction)
@@ -663,9 +715,9 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
                 self._DFAR().value = vaddress
                 self._DFSR().value = ex.domain << 4 | (fs & 0xF) | ((fs & 0x10) << 10)
         else:
-            return self.system_bus.read(paddress)
+            return self.bus_port.read(paddress, size)
         
-    def mmu_write(self, vaddress, value, instruction=False):
+    def mmu_write(self, vaddress, value, instruction=False, size=4):
         fs = None
         try:
             paddress = self._mmu_translate(vaddress, read_access=False, instruction=instruction)
@@ -690,12 +742,18 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
                 self._DFAR().value = vaddress
                 self._DFSR().value = ex.domain << 4 | (fs & 0xF) | ((fs & 0x10) << 10) | (1 << 11)
         else:
-            self.system_bus.write(paddress, value)
+            self.bus_port.write(paddress, value, size)
                 
     def fetch_next_op(self):
-        self.logger.info("Fetching next opcode from address (%s)", hex(self.ip.value))
-        op = self.mmu_read(self.ip.value, instruction=True)
-        return op.value
+        ip = self.ip.value
+        if tracer.enabled:
+            # Memory records carry the pc of the instruction that issued them.
+            tracer.pc = ip
+            op = self.mmu_read(ip, instruction=True)
+            if tracer.fetch:
+                tracer.record(FETCH, ip, op)
+            return op
+        return self.mmu_read(ip, instruction=True)
     
     def init_ophandlers(self):
         def def_LDR_LITERAL_OP(op):
@@ -778,10 +836,10 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
             offset = self._SHIFT(self.register_read(rm).value, shift_t, shift_n, carry)
             value = self.register_read(rn).value
             offset_addr = (value + offset) if add else (value - offset)
-            address = offset_addr if index else self.register_read(rn)
+            address = offset_addr if index else value
             data = self.mmu_read(address)
             if wback:
-                self.register_write(rn, c_uint32(data))
+                self.register_write(rn, data)
             if rt == 0xF:
                 if address & 3 == 0:
                     self._LoadWritePC(data)
@@ -819,10 +877,10 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
             rn_value = self.register_read(rn).value
             offset_addr = (rn_value + imm) if add else (rn_value - imm)
             address = offset_addr if index else rn_value
-            self.mmu_write(address, self.register_read(rt))
+            self.mmu_write(address, self.register_read(rt).value)
             
             if wback:
-                self.register_write(rn, c_uint32(offset_addr))
+                self.register_write(rn, offset_addr)
                 
             return False
         
@@ -860,29 +918,32 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
                 #FIXME see PCStoreValue
                 raise NotImplementedOpCode()
             else:
-                data = self.register_read(rt)
+                data = self.register_read(rt).value
                 
             self.mmu_write(address, data)
             if wback:
-                self.register_write(rn, c_uint32(offset_addr))
+                self.register_write(rn, offset_addr)
                 
             return False
                 
         def def_B_OP(op):
             imm = self._SignExtend26to32((op & self.B_IMM) << 2)
-            self.set_ip(c_uint32(self.get_ip() + imm))
+            if imm == -8 and self.idle_detection:
+                # B . only ever leaves through an interrupt.
+                self._Idle()
+            self._BranchWritePC(self.get_ip() + imm)
             return True
 
         def def_BL_OP(op):
             imm = self._SignExtend26to32((op & self.B_IMM) << 2)
             lr = self.get_lr_link()
-            self.register_write(14, c_uint32(lr))
-            self.set_ip(c_uint32(self.get_ip() + imm))
+            self.register_write(14, lr)
+            self._BranchWritePC(self.get_ip() + imm)
             return True
         
         def def_BX_OP(op):
             rm = op & self.BX_RM
-            address = self.register_read(rm)
+            address = self.register_read(rm).value
             self._BXWritePC(address)
             return True
 
@@ -913,7 +974,7 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
                 self._BXWritePC(self.mmu_read(address))
 
             if wback:
-                self.register_write(rn, c_uint32(address))
+                self.register_write(rn, address)
             
             return False
 
@@ -931,14 +992,14 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
                 if register_list & (1 << i):
                     #TODO:Check the reference for the branching here, not sure what it means !!
                     #if rn == i and wback and 
-                    self.mmu_write(address, self.register_read(i))
+                    self.mmu_write(address, self.register_read(i).value)
                     address += 4
                 
             if register_list & (1 << 15):
                 # PCStoreValue
                 raise NotImplementedOpCode()
             if wback:
-                self.register_write(rn, c_uint32(address))
+                self.register_write(rn, address)
                 
             return False
 
@@ -958,7 +1019,7 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
                 if register_list & (1 << i):
                     #TODO:Check the reference for the branching here, not sure what it means !!
                     #if rn == i and wback and 
-                    self.mmu_write(address, self.register_read(i))
+                    self.mmu_write(address, self.register_read(i).value)
                     address += 4
             if register_list & (1 << 15):
                 # see PCStoreValue(pc)
@@ -976,7 +1037,7 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
                 raise NotImplementedOpCode()
 
             address = self.register_read(13).value - 4
-            self.mmu_write(address, self.register_read(rt))
+            self.mmu_write(address, self.register_read(rt).value)
             self.register_read(13).value -= 4
             return False
             
@@ -1062,6 +1123,13 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
             self.cpsr.value |= carry and self.PROCESSOR_C
             return False
         
+        def def_HINT_OP(op):
+            option = op & self.HINT_OPTION
+            if (option == self.HINT_WFI or option == self.HINT_WFE) and self.idle_detection:
+                # SEV isn't modelled, WFE waits for an interrupt like WFI.
+                self._Idle()
+            return False
+        
         def def_MSR_REGISTER_OP(op):
             #TODO:Support non-maskable interrupts
             rn = op & self.MSR_REGISTER_RN
@@ -1110,10 +1178,10 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
             imm, carry = self._ARMExpandImm_C(imm, carry)
             result = self._NOT(imm)
             if rd == 0xF:
-                self._ALUWritePC(c_uint32(result))
+                self._ALUWritePC(result)
                 skip = True
             else:
-                self.register_write(rd, c_uint32(result))
+                self.register_write(rd, result)
                 if set_flags:
                     self.cpsr.value |= (result & 0x80000000) and self.PROCESSOR_N
                     self.cpsr.value |= (result == 0) and self.PROCESSOR_Z
@@ -1137,7 +1205,7 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
             carry = self.cpsr.value & self.PROCESSOR_C and 1
             shifted, carry = self._SHIFT_C(self.register_read(rm).value, shift_t, shift_n, carry)
             result = self._NOT(shifted)
-            self.register_write(rd, c_uint32(result))
+            self.register_write(rd, result)
             if set_flags:
                 self.cpsr.value |= (result & 0x80000000) and self.PROCESSOR_N
                 self.cpsr.value |= (result == 0) and self.PROCESSOR_Z
@@ -1161,10 +1229,10 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
             imm, carry = self._ARMExpandImm_C(imm, carry)
             result = (self.register_read(rn).value & self._NOT(imm))
             if rd == 0xF:
-                self._ALUWritePC(c_uint32(result))
+                self._ALUWritePC(result)
                 skip = True
             else:
-                self.register_write(rd, c_uint32(result))
+                self.register_write(rd, result)
                 if set_flags:
                     self.cpsr.value |= (result & 0x80000000) and self.PROCESSOR_N
                     self.cpsr.value |= (result == 0) and self.PROCESSOR_Z
@@ -1185,7 +1253,7 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
             else:
                 value &= self.MRS_USER_MASK
             
-            self.register_write(rd, c_uint32(value))
+            self.register_write(rd, value)
             return False
 
         def def_ORR_REGISTER_OP(op):
@@ -1208,10 +1276,10 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
             result = self.register_read(rn).value | shifted
             
             if rd == 0xF:
-                self._ALUWritePC(c_uint32(result))
+                self._ALUWritePC(result)
                 skip = True
             else:
-                self.register_write(rd, c_uint32(result))
+                self.register_write(rd, result)
                 if set_flags:
                     self.cpsr.value |= (result & 0x80000000) and self.PROCESSOR_N
                     self.cpsr.value |= (result == 0) and self.PROCESSOR_Z
@@ -1235,10 +1303,10 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
             result = self.register_read(rn).value | imm
             
             if rd == 0xF:
-                self._ALUWritePC(c_uint32(result))
+                self._ALUWritePC(result)
                 skip = True
             else:
-                self.register_write(rd, c_uint32(result))
+                self.register_write(rd, result)
                 if set_flags:
                     self.cpsr.value |= (result & 0x80000000) and self.PROCESSOR_N
                     self.cpsr.value |= (result == 0) and self.PROCESSOR_Z
@@ -1263,7 +1331,7 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
             carry = (self.cpsr.value & self.PROCESSOR_C) and 1
             shifted, carry = self._SHIFT_C(self.register_read(rm).value, shift_t, shift_n, carry)
             result = self.register_read(rn).value | shifted
-            self.register_write(rd, c_uint32(result))
+            self.register_write(rd, result)
             if set_flags:
                     self.cpsr.value |= (result & 0x80000000) and self.PROCESSOR_N
                     self.cpsr.value |= (result == 0) and self.PROCESSOR_Z
@@ -1288,7 +1356,7 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
             carry = (self.cpsr.value & self.PROCESSOR_C) and 1
             shifted, carry = self._SHIFT_C(self.register_read(rm).value, shift_t, shift_n, carry)
             result = self.register_read(rn).value & self._NOT(shifted)
-            self.register_write(rd, c_uint32(result))
+            self.register_write(rd, result)
             if set_flags:
                     self.cpsr.value |= (result & 0x80000000) and self.PROCESSOR_N
                     self.cpsr.value |= (result == 0) and self.PROCESSOR_Z
@@ -1317,7 +1385,7 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
             crm = op & self.MRC_CRM
             if coproc == 0xF:
                 value = self._CP15_read(crn, opc1, crm, opc2)
-                self.register_write(rt, value)
+                self.register_write(rt, value.value)
             else:
                 raise NotImplementedOpCode()
             return False
@@ -1334,10 +1402,10 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
             carry = self.cpsr.value & self.PROCESSOR_C and 1
             result, carry = self._SHIFT_C(self.register_read(rm).value, self.SRType_LSR, shift_n, carry)
             if rd == 0xF:
-                self._ALUWritePC(c_uint32(result))
+                self._ALUWritePC(result)
                 skip = True
             else:
-                self.register_write(rd, c_uint32(result))
+                self.register_write(rd, result)
                 if set_flags:
                     self.cpsr.value |= (result & 0x80000000) and self.PROCESSOR_N
                     self.cpsr.value |= (result == 0) and self.PROCESSOR_Z
@@ -1356,10 +1424,10 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
             carry = self.cpsr.value & self.PROCESSOR_C and 1
             result, carry = self._SHIFT_C(self.register_read(rm).value, self.SRType_LSL, shift_n, carry)
             if rd == 0xF:
-                self._ALUWritePC(c_uint32(result))
+                self._ALUWritePC(result)
                 skip = True
             else:
-                self.register_write(rd, c_uint32(result))
+                self.register_write(rd, result)
                 if set_flags:
                     self.cpsr.value |= (result & 0x80000000) and self.PROCESSOR_N
                     self.cpsr.value |= (result == 0) and self.PROCESSOR_Z
@@ -1385,10 +1453,10 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
             shifted, carry = self._SHIFT_C(self.register_read(rm).value, shift_t, shift_n, carry)
             result = self.register_read(rn).value | shifted 
             if rd == 0xF:
-                self._ALUWritePC(c_uint32(result))
+                self._ALUWritePC(result)
                 skip = True
             else:
-                self.register_write(rd, c_uint32(result))
+                self.register_write(rd, result)
                 if set_flags:
                     self.cpsr.value |= (result & 0x80000000) and self.PROCESSOR_N
                     self.cpsr.value |= (result == 0) and self.PROCESSOR_Z
@@ -1411,10 +1479,10 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
             imm, carry = self._ARMExpandImm_C(imm, carry)
             result = self.register_read(rn).value & imm
             if rd == 0xF:
-                self._ALUWritePC(c_uint32(result))
+                self._ALUWritePC(result)
                 skip = True
             else:
-                self.register_write(rd, c_uint32(result))
+                self.register_write(rd, result)
                 if set_flags:
                     self.cpsr.value |= (result & 0x80000000) and self.PROCESSOR_N
                     self.cpsr.value |= (result == 0) and self.PROCESSOR_Z
@@ -1439,7 +1507,7 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
                 #FIXME see SUBS PC, LR and related instructions.
                 raise NotImplementedOpCode()
             
-            self.register_write(rd, c_uint32(result))
+            self.register_write(rd, result)
             if set_flags:
                 self.cpsr.value |= (result & 0x80000000) and self.PROCESSOR_N
                 self.cpsr.value |= (result == 0) and self.PROCESSOR_Z
@@ -1471,10 +1539,10 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
             result, carry, overflow = self._AddWithCarry(self.register_read(rn).value, shifted, 0)
             
             if rd == 0xF:
-                self._ALUWritePC(c_uint32(result))
+                self._ALUWritePC(result)
                 skip = True
             else:
-                self.register_write(rd, c_uint32(result))
+                self.register_write(rd, result)
                 
                 if set_flags:
                     self.cpsr.value |= (result & 0x80000000) and self.PROCESSOR_N
@@ -1508,10 +1576,10 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
             result, carry, overflow = self._AddWithCarry(self.register_read(rn).value, complemented_shifted, 0)
             
             if rd == 0xF:
-                self._ALUWritePC(c_uint32(result))
+                self._ALUWritePC(result)
                 skip = True
             else:
-                self.register_write(rd, c_uint32(result))
+                self.register_write(rd, result)
                 if set_flags:
                     self.cpsr.value |= (result & 0x80000000) and self.PROCESSOR_N
                     self.cpsr.value |= (result == 0) and self.PROCESSOR_Z
@@ -1544,10 +1612,38 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
             value = self.register_read(rn).value
             offset_addr = (value + imm) if add else (value - imm)
             address = offset_addr if index else value
-            tmp_value = self.mmu_read(address).value
-            self.register_write(rt, c_uint32(tmp_value & 0xFF))
+            self.register_write(rt, self.mmu_read(address, size=1))
+            if wback:
+                self.register_write(rn, offset_addr)
+            return False
+
+        def def_STRB_IMMEDIATE_OP(op):
+            rn = (op & self.STRB_IMMEDIATE_RN) >> self.STRB_IMMEDIATE_RN_SHIFT
+            rt = (op & self.STRB_IMMEDIATE_RT) >> self.STRB_IMMEDIATE_RT_SHIFT
+            p = op & self.STRB_IMMEDIATE_P
+            u = op & self.STRB_IMMEDIATE_U
+            w = op & self.STRB_IMMEDIATE_W
+            imm = op & self.STRB_IMMEDIATE_IMM
+            
+            if not p and w != 0:
+                #FIXME see STRBT
+                raise NotImplementedOpCode()
+            
+            index = p != 0
+            add = u != 0
+            wback = (p == 0) or (w != 0)
+            
+            if rt == 0xF:
+                raise Unpredictable()
+            if wback and (rn == 0xF or rn == rt):
+                raise Unpredictable()
+            
+            value = self.register_read(rn).value
+            offset_addr = (value + imm) if add else (value - imm)
+            address = offset_addr if index else value
+            self.mmu_write(address, self.register_read(rt).value & 0xFF, size=1)
             if wback:
-                self.register_write(rn, c_uint32(offset_addr))
+                self.register_write(rn, offset_addr)
             return False
 
         def def_SUB_IMMEDIATE_OP(op):
@@ -1578,10 +1674,10 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
                 result, carry, overflow = self._AddWithCarry(self.register_read(rn).value, self._NOT(imm), 1)
             
             if rd == 0xF:
-                self._ALUWritePC(c_uint32(result))
+                self._ALUWritePC(result)
                 skip = True
             else:
-                self.register_write(rd, c_uint32(result))
+                self.register_write(rd, result)
                 if set_flags:
                     self.cpsr.value |= (result & 0x80000000) and self.PROCESSOR_N
                     self.cpsr.value |= (result == 0) and self.PROCESSOR_Z
@@ -1599,10 +1695,10 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
             carry = self.cpsr.value & self.PROCESSOR_C and 1
             result, carry = self._ARMExpandImm_C(imm, carry)
             if rd == 0xF:
-                self._ALUWritePC(c_uint32(result))
+                self._ALUWritePC(result)
                 skip = True
             else:
-                self.register_write(rd, c_uint32(result))
+                self.register_write(rd, result)
                 if set_flags:
                     self.cpsr.value |= (result & 0x80000000) and self.PROCESSOR_N
                     self.cpsr.value |= (result == 0) and self.PROCESSOR_Z
@@ -1615,15 +1711,15 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
             rm = op & self.MOV_REGISTER_RM
             s = op & self.MOV_REGISTER_S
             set_flags = (s != 0)
-            result = self.register_read(rm)
+            result = self.register_read(rm).value
             if rd == 0xF:
                 self._ALUWritePC(result)
                 skip = True
             else:
                 self.register_write(rd, result)
                 if set_flags:
-                    self.cpsr.value |= (result.value & 0x80000000) and self.PROCESSOR_N
-                    self.cpsr.value |= (result.value == 0) and self.PROCESSOR_Z
+                    self.cpsr.value |= (result & 0x80000000) and self.PROCESSOR_N
+                    self.cpsr.value |= (result == 0) and self.PROCESSOR_Z
             return skip
         
         def def_BFC_OP(op):
@@ -1640,7 +1736,7 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
             mask = c_uint32(~complemented_mask).value
             rd_value = self.register_read(rd).value
             masked_value = rd_value & mask
-            self.register_write(rd,c_uint32(masked_value))
+            self.register_write(rd, masked_value)
             return False
         
         def def_MOV_IMMEDIATE_OP2(op):
@@ -1652,7 +1748,7 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
             if rd == 0xF:
                 raise Unpredictable()
             else:
-                self.register_write(rd, c_uint32(imm))
+                self.register_write(rd, imm)
 
 
         self.op_handlers = {            
@@ -1661,6 +1757,7 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
                             'LDRB_IMMEDIATE_OP' : def_LDRB_IMMEDIATE_OP,
                             'LDR_REGISTER_OP'   : def_LDR_REGISTER_OP,
                             'STR_IMMEDIATE_OP'  : def_STR_IMMEDIATE_OP,
+                            'STRB_IMMEDIATE_OP' : def_STRB_IMMEDIATE_OP,
                             'STR_REGISTER_OP'   : def_STR_REGISTER_OP,
                             'BFC_OP'            : def_BFC_OP,
                             'B_OP'              : def_B_OP,
@@ -1676,6 +1773,7 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
                             'CMP_IMMEDIATE_OP'  : def_CMP_IMMEDIATE_OP,
                             'TST_IMMEDIATE_OP'  : def_TST_IMMEDIATE_OP,
                             'MSR_REGISTER_OP'   : def_MSR_REGISTER_OP,
+                            'HINT_OP'           : def_HINT_OP,
                             'MVN_IMMEDIATE_OP'  : def_MVN_IMMEDIATE_OP,
                             'MVN_REGISTER_SH_OP': def_MVN_REGISTER_SH_OP,
                             'BIC_IMMEDIATE_OP'  : def_BIC_IMMEDIATE_OP,
@@ -1700,8 +1798,9 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
                             }
         
     def init_registers(self):
-        self.cpsr   = CPSR_RESET
-        self.ip     = INITIAL_IP
+        # Own copies, the reset values are shared by every cpu.
+        self.cpsr   = c_uint32(CPSR_RESET.value)
+        self.ip     = c_uint32(INITIAL_IP.value)
         
         self.registers = {}
         
@@ -1783,7 +1882,7 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
                             self.cp15_registers[crn] = {opc1: {crm: {opc2: {bank: value}}}}
 
         # crn, opc1, crm, opc2, bank(0 => secure, 1 => non-secure)
-        midr = MIDR_RESET
+        midr = c_uint32(MIDR_RESET.value)
         init_cp15_register(0, 0, 0, 0, True, midr) # VBAR ( common )
         init_cp15_register(12, 0, 0, 0, True, c_uint32()) # VBAR ( secure )
         init_cp15_register(12, 0, 0, 0, False, c_uint32()) # VBAR ( non-secure )
@@ -1838,12 +1937,52 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
                     0x6: 0x1C
                 }
         
+    def get_state(self):
+        '''
+            The architectural state as plain ints, keyed by processor mode.
+        '''
+        cp15 = []
+        for crn, opc1s in self.cp15_registers.items():
+            for opc1, crms in opc1s.items():
+                for crm, opc2s in crms.items():
+                    for opc2, banks in opc2s.items():
+                        for bank, register in banks.items():
+                            cp15.append([crn, opc1, crm, opc2, bank, register.value])
+        
+        return {
+                'ip'        : self.ip.value,
+                'cpsr'      : self.cpsr.value,
+                'icount'    : self.icount,
+                'registers' : dict((mode, [register.value for register in registers]) for mode, registers in self.registers.items()),
+                'spsr'      : dict((mode, register.value) for mode, register in self.spsr_registers.items()),
+                'cp15'      : sorted(cp15),
+                'received_interrupts' : dict(self.received_interrupts)
+               }
+    
+    def set_state(self, state):
+        '''
+            Loads a get_state() result, possibly read back from JSON (string keys). The values
+            are written into the existing registers so the banked copies stay shared.
+        '''
+        self.ip.value = state['ip']
+        self.cpsr.value = state['cpsr']
+        self.icount = state['icount']
+        for mode, values in state['registers'].items():
+            for register, value in zip(self.registers[int(mode)], values):
+                register.value = value
+        for mode, value in state['spsr'].items():
+            self.spsr_registers[int(mode)].value = value
+        for crn, opc1, crm, opc2, bank, value in state['cp15']:
+            self.cp15_registers[crn][opc1][crm][opc2][bank].value = value
+        self.received_interrupts = dict((int(interrupt), value) for interrupt, value in state['received_interrupts'].items())
+    
     def register_read(self, register_index):
         return self.registers[self.cpsr.value & self.PROCESSOR_MODE][register_index] 
 
-    def register_write(self, register_index, reg):
+    def register_write(self, register_index, value):
+        # value is a plain int, the register truncates it to 32 bits.
         register = self.registers[self.cpsr.value & self.PROCESSOR_MODE][register_index]
-        register.value = reg.value
+        register.value = value
 
     IRQ_UNDEFINED   = 0x0
     IRQ_SMC         = 0x1
@@ -1854,6 +1993,13 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
     IRQ_FIQ         = 0x6
     def interrupt_triggered(self, returned_irq):
         self.received_interrupts[returned_irq] = True 
+        self._wake()
+        interrupt = self._plugins.get('interrupt')
+        if interrupt:
+            pc = self.ip.value
+            for callback, start, end in interrupt:
+                if start <= pc < end:
+                    callback(self, pc, returned_irq)
     
     def _TakeException(self):
         interrupt_found = False
@@ -1965,7 +2111,7 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
         self.spsr_registers[MODE].value = self.cpsr.value
         
         # set lr
-        self.registers[MODE][14] = lr
+        self.registers[MODE][14].value = lr
         
         # setting the new cpsr
         self.cpsr.value = new_cpsr 
@@ -1981,7 +2127,7 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
             
         offset = self.interrupt_offset_map[interrupt]
         ip = exception_base_address + offset
-        self.set_ip(c_uint32(ip))
+        self.set_ip(ip)
 
     # TODO Use later
     def _IsSecurityExtImplemented(self):
@@ -2007,16 +2153,20 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
     SVC_COPROC_INS_MASK         = 0x0C000000
     SVC_COPROC_INS              = 0x0C000000
     def execute(self):
+        if self.icount >= self._next_event:
+            self._run_events()
         self._TakeException()
         skip = False
         self.op = op = self.fetch_next_op()
 
-        global_env.dbg_event.wait()
-        if global_env.STEPPING or op in global_env.GDB_ops or self.ip.value in global_env.GDB_IPs:
-            global_env.dbg_breakpoint_hit = True
-            global_env.dbg_event.clear()
-            global_env.dbg_event.wait()
+        context = self.context
+        context.dbg_event.wait()
+        if context.STEPPING or op in context.GDB_ops or self.ip.value in context.GDB_IPs:
+            context.dbg_breakpoint_hit = True
+            context.dbg_event.clear()
+            context.dbg_event.wait()
         
+        self.icount += 1
         condition = (op & self.CONDITION_MASK) >> self.CONDITION_MASK_SHIFT
         
         proceed = False
@@ -2066,6 +2216,8 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
                 skip = self.op_handlers['LDR_REGISTER_OP'](op)
             elif (op & self.STR_IMMEDIATE_OP_MASK) == self.STR_IMMEDIATE_OP:
                 skip = self.op_handlers['STR_IMMEDIATE_OP'](op)
+            elif (op & self.STRB_IMMEDIATE_OP_MASK) == self.STRB_IMMEDIATE_OP:
+                skip = self.op_handlers['STRB_IMMEDIATE_OP'](op)
             elif (op & self.STR_REGISTER_OP_MASK) == self.STR_REGISTER_OP:
                 skip = self.op_handlers['STR_REGISTER_OP'](op)
             else:
@@ -2140,6 +2292,8 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
                 skip = self.op_handlers['MSR_REGISTER_OP'](op)
             elif (op & self.BX_OP_MASK) == self.BX_OP:
                 skip = self.op_handlers['BX_OP'](op)
+            elif (op & self.HINT_OP_MASK) == self.HINT_OP:
+                skip = self.op_handlers['HINT_OP'](op)
             else:
                 raise NotImplementedOpCode()
         elif (op & self.SVC_COPROC_INS_MASK) == self.SVC_COPROC_INS: 
@@ -2340,13 +2494,16 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
             raise NotImplementedOpCode()
         
     def _BXWritePC(self, address):
-        if address.value & 1:
+        if address & 1:
             raise NotImplementedInstructionSet()
-        elif address.value & 2 == 0:
+        elif address & 2 == 0:
             self.set_ip(address)
         else:
             raise Unpredictable()
     
+    def _BranchWritePC(self, address):
+        self.set_ip(address)
+    
     def _IsMonitorMode(self):
         return (self.cpsr.value & self.PROCESSOR_MODE) == 0x16
     
@@ -2653,7 +2810,7 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
         raise NoRegisterFound()
     
     def set_ip(self, address):
-        self.ip.value = address.value
+        self.ip.value = address
         
     def get_ip(self):
         thumb = self.cpsr.value & self.PROCESSOR_THUMB 
@@ -2664,10 +2821,161 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
         return (self.ip.value + 4) if not thumb else (self.ip.value + 2)
     
     def next_op(self):
-        self.set_ip(c_uint32(self.ip.value + self.word_size))
+        self.set_ip(self.ip.value + self.word_size)
+    
+    def schedule(self, icount, callback):
+        '''
+            Calls callback(cpu) before the next instruction once icount instructions have
+            executed. Events scheduled for the same icount run in the order they were added.
+        '''
+        heapq.heappush(self._events, (icount, self._event_sequence, callback))
+        self._event_sequence += 1
+        self._next_event = self._events[0][0]
+    
+    def post(self, callback):
+        '''
+            Calls callback(cpu) from our own thread before the next instruction. Unlike
+            schedule, this is safe to call from any thread.
+        '''
+        self._posted.append(callback)
+        self._next_event = 0
+        self._wake()
+    
+    def _run_events(self):
+        while self._posted:
+            self._posted.pop(0)(self)
+        while self._events and self._events[0][0] <= self.icount:
+            _, _, callback = heapq.heappop(self._events)
+            callback(self)
+        self._next_event = self._events[0][0] if self._events else NO_EVENT
+        # A post that raced with us must not wait for the next scheduled event.
+        if self._posted:
+            self._next_event = 0
+    
+    def _Idle(self):
+        '''
+            The guest waits for an interrupt (B ., WFI or WFE). Under virtual time the
+            instruction count jumps to the next scheduled event, as if the guest had spun until
+            then. With nothing scheduled, the thread sleeps until an interrupt is asserted or
+            a callback is posted. Otherwise the guest keeps spinning so scheduled events still
+            come at the same instruction.
+        '''
+        if True in self.received_interrupts.values():
+            return
+        
+        if self._next_event != NO_EVENT:
+            if self.virtual_time and self._next_event > self.icount:
+                self.idle_skipped += self._next_event - self.icount
+                self.icount = self._next_event
+            return
+        
+        with self._idle_condition:
+            while not (self._posted or self._stopped or True in self.received_interrupts.values()):
+                # The debugger wants the cpu back, e.g. to single step.
+                if self.context.STEPPING or not self.context.dbg_event.isSet():
+                    break
+                self._idle_condition.wait(IDLE_POLL)
+    
+    def _wake(self):
+        with self._idle_condition:
+            self._idle_condition.notify()
+    
+    PLUGIN_EVENTS = ('insn', 'mem', 'branch', 'exception', 'interrupt')
+    def register_plugin(self, event, callback, start=0, end=1 << 32):
+        '''
+            Calls callback for every event of the given class whose address is in [start, end):
+                insn      : callback(cpu, pc, op), before the instruction executes.
+                mem       : callback(cpu, vaddress, value, size, write), after a data access.
+                branch    : callback(cpu, pc, target), when a branch writes the pc.
+                exception : callback(cpu, pc, vector), pc is where the exception returns to.
+                interrupt : callback(cpu, pc, irq), when an interrupt is asserted.
+            The address filtered on is vaddress for memory events and pc otherwise.
+            
+            Callbacks are installed by shadowing the methods involved on this instance only,
+            an event class without callbacks costs nothing. Interrupts are rare enough to be
+            dispatched from interrupt_triggered itself.
+        '''
+        if event not in self.PLUGIN_EVENTS:
+            raise UnknownPluginEvent(event)
+        self._plugins.setdefault(event, []).append((callback, start, end))
+        self._install_plugins()
+    
+    def unregister_plugin(self, event, callback):
+        callbacks = [hook for hook in self._plugins.get(event, []) if hook[0] != callback]
+        if callbacks:
+            self._plugins[event] = callbacks
+        else:
+            self._plugins.pop(event, None)
+        self._install_plugins()
+    
+    def _install_plugins(self):
+        for name in ('fetch_next_op', 'mmu_read', 'mmu_write', '_BranchWritePC', '_BXWritePC', '_TakeException'):
+            self.__dict__.pop(name, None)
+        
+        insn = self._plugins.get('insn')
+        if insn:
+            fetch_next_op = self.fetch_next_op
+            def plugin_fetch_next_op():
+                pc = self.ip.value
+                op = fetch_next_op()
+                for callback, start, end in insn:
+                    if start <= pc < end:
+                        callback(self, pc, op)
+                return op
+            self.fetch_next_op = plugin_fetch_next_op
+        
+        mem = self._plugins.get('mem')
+        if mem:
+            mmu_read = self.mmu_read
+            mmu_write = self.mmu_write
+            def plugin_mmu_read(vaddress, instruction=False, size=4):
+                value = mmu_read(vaddress, instruction, size)
+                if not instruction:
+                    for callback, start, end in mem:
+                        if start <= vaddress < end:
+                            callback(self, vaddress, value, size, False)
+                return value
+            
+            def plugin_mmu_write(vaddress, value, instruction=False, size=4):
+                mmu_write(vaddress, value, instruction, size)
+                if not instruction:
+                    for callback, start, end in mem:
+                        if start <= vaddress < end:
+                            callback(self, vaddress, value, size, True)
+            self.mmu_read = plugin_mmu_read
+            self.mmu_write = plugin_mmu_write
+        
+        branch = self._plugins.get('branch')
+        if branch:
+            def branch_hook(write_pc):
+                def plugin_write_pc(address):
+                    pc = self.ip.value
+                    write_pc(address)
+                    for callback, start, end in branch:
+                        if start <= pc < end:
+                            callback(self, pc, address)
+                return plugin_write_pc
+            # _LoadWritePC and _ALUWritePC end up in _BXWritePC.
+            self._BranchWritePC = branch_hook(self._BranchWritePC)
+            self._BXWritePC = branch_hook(self._BXWritePC)
+        
+        exception = self._plugins.get('exception')
+        if exception:
+            take_exception = self._TakeException
+            def plugin_TakeException():
+                pc = self.ip.value
+                take_exception()
+                vector = self.ip.value
+                if vector == pc:
+                    return
+                for callback, start, end in exception:
+                    if start <= pc < end:
+                        callback(self, pc, vector)
+            self._TakeException = plugin_TakeException
     
     _stopped = False
     def run(self):
+        self.run_thread = threading.current_thread()
         while True:
             if self._stopped:
                 sys.exit(0)
@@ -2676,7 +2984,12 @@ class ARMCortexA9(threading.Thread, AbstractInterruptConsumer):
     
     def stop(self):
         self._stopped = True
+        self._wake()
     
     def get_info(self):
-        return '''Instruction pointer    : %s
-Opcode    : %s''' % (hex(self.ip.value), hex(self.op))
\ No newline at end of file
+        info = '''Instruction pointer    : %s
+Opcode    : %s
+Instructions    : %s''' % (hex(self.ip.value), hex(self.op), self.icount)
+        if self.opstats is not None:
+            info += '\n' + self.opstats.report()
+        return info
\ No newline at end of file
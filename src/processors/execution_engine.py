@@ -1,6 +1,7 @@
 import logging
 import types
 from processors.op_codes import simple_opcodes
+from instrumentation.trace import tracer, FETCH
 import threading
 
 INITIAL_IP = 0x0
@@ -11,14 +12,12 @@ class SimpleEngine(threading.Thread):
         self.logger = logging.getLogger(name)
         self.name = name
         self.system_bus = system_bus
+        # The bus bank used for our accesses is our name.
+        self.bus_port = system_bus.get_port(self.name)
         self.ip = INITIAL_IP
         self.word_size = 4
         self.op_handlers = {}
         
-        local_storage = threading.local()
-        # will be used to identify the current executing engine.
-        local_storage.engine_id = self.name
-        
     def load_opcodes(self, module):
         for attr in dir(module):
             attribute = getattr(module, attr)
@@ -26,8 +25,11 @@ class SimpleEngine(threading.Thread):
                 self.op_handlers[attr[3:]] = attribute
                 
     def fetch_next_op(self, ip):
-        self.logger.info("Fetching next opcode from address (%s)", ip)
-        op = self.system_bus.read(ip)
+        op = self.bus_port.read(ip)
+        if tracer.enabled:
+            tracer.pc = ip
+            if tracer.fetch:
+                tracer.record(FETCH, ip, op)
         return op
         
     def execute(self, op):
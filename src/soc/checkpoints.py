@@ -0,0 +1,255 @@
+'''
+    In-memory checkpoints for reverse execution.
+
+    CheckpointRing keeps the last few machine states, one every interval instructions. A
+    checkpoint holds the cpu and device states and only the memory pages written since the
+    previous checkpoint, the dirty tracking of the memories tells which. The page strings are
+    immutable and shared, so a page that isn't written again is never copied again. When the
+    ring is full the oldest checkpoint is folded into the next one.
+
+    goto(icount) restores the nearest checkpoint at or before icount and replays forward to
+    it. Interrupts seen since the oldest checkpoint are logged and injected again at the
+    same instruction, so the replay takes the same path as long as the guest only depends on
+    them (see host_frontends.replay for the other inputs). Interrupts asserted from other
+    threads (timers) are handed over to the cpu thread with cpu.post, like EventRecorder does
+    when there is one, so they are logged at the instruction that observes them. Those arriving
+    during a replay are held back and delivered once goto() is done.
+
+    The ring takes over the dirty bits of the memories, don't combine it with PageStore.save
+    incremental saves in the same run. Events scheduled by others aren't rewound.
+'''
+import logging
+import threading
+
+from soc import snapshot
+
+class Checkpoint(object):
+    def __init__(self, icount, state, pages):
+        self.icount = icount
+        # A snapshot.capture_state() header.
+        self.state = state
+        # memory name => {page: contents}, every page for the oldest checkpoint.
+        self.pages = pages
+
+class CheckpointRing(object):
+    def __init__(self, cpu, memories, devices={}, interval=100000, capacity=16):
+        self.cpu = cpu
+        self.cpus = {cpu.name: cpu}
+        self.memories = memories
+        self.devices = devices
+        self.interval = interval
+        self.capacity = capacity
+        self.checkpoints = []
+        # [(icount, irq)] asserted since the oldest checkpoint.
+        self.interrupts = []
+        self.logger = logging.getLogger("checkpoints")
+        # Outdates the checkpoint event scheduled before a rewind.
+        self._generation = 0
+        self._replaying = False
+        self._cpu_thread = None
+        self._interrupt_triggered = None
+        # Interrupts from other threads that arrived while replaying.
+        self._held = []
+
+    def attach(self):
+        '''
+            Takes the first checkpoint before the next instruction, safe from any thread.
+        '''
+        self.cpu.post(self._start)
+
+    def _start(self, cpu):
+        self._cpu_thread = threading.current_thread()
+        # A host_frontends.replay event log already hands them over, and logs them on the way.
+        if 'interrupt_triggered' not in cpu.__dict__:
+            self._interrupt_triggered = cpu.interrupt_triggered
+            cpu.interrupt_triggered = self._on_interrupt_triggered
+        cpu.register_plugin('interrupt', self._on_interrupt)
+        self._take(cpu, self._generation)
+
+    def detach(self):
+        self.cpu.unregister_plugin('interrupt', self._on_interrupt)
+        if self._interrupt_triggered is not None:
+            self.cpu.interrupt_triggered = self._interrupt_triggered
+            self._interrupt_triggered = None
+        self._generation += 1
+
+    def _on_interrupt_triggered(self, returned_irq):
+        if threading.current_thread() is self._cpu_thread:
+            self._interrupt_triggered(returned_irq)
+            return
+
+        def deliver(cpu):
+            if self._replaying:
+                self._held.append(returned_irq)
+            else:
+                self._interrupt_triggered(returned_irq)
+        self.cpu.post(deliver)
+
+    def _arm(self, icount):
+        generation = self._generation
+        self.cpu.schedule(icount, lambda cpu: self._take(cpu, generation))
+
+    def _on_interrupt(self, cpu, pc, irq):
+        if not self._replaying:
+            self.interrupts.append((cpu.icount, irq))
+
+    def _take(self, cpu, generation):
+        if generation != self._generation:
+            return
+
+        pages = {}
+        for name, memory in self.memories.items():
+            image = memory.image()
+            size = memory.page_size()
+            if self.checkpoints:
+                written = memory.dirty_pages()
+            else:
+                written = range((len(image) + size - 1) / size)
+            pages[name] = dict((page, str(image[page * size:(page + 1) * size])) for page in written)
+            memory.clear_dirty()
+
+        state = snapshot.capture_state(self.cpus, self.devices)
+        self.checkpoints.append(Checkpoint(cpu.icount, state, pages))
+        if len(self.checkpoints) > self.capacity:
+            self._fold()
+        self._arm(cpu.icount + self.interval)
+
+    def _fold(self):
+        oldest = self.checkpoints.pop(0)
+        following = self.checkpoints[0]
+        for name, pages in oldest.pages.items():
+            pages.update(following.pages[name])
+            following.pages[name] = pages
+        self.interrupts = [entry for entry in self.interrupts if entry[0] >= following.icount]
+
+    def oldest(self):
+        return self.checkpoints[0].icount if self.checkpoints else None
+
+    def _nearest(self, icount):
+        index = 0
+        for i, checkpoint in enumerate(self.checkpoints):
+            if checkpoint.icount <= icount:
+                index = i
+        return index
+
+    def _restore(self, index):
+        checkpoint = self.checkpoints[index]
+        for name, memory in self.memories.items():
+            image = memory.image()
+            size = memory.page_size()
+            written = set(memory.dirty_pages())
+            for later in self.checkpoints[index + 1:]:
+                written.update(later.pages[name])
+            for page in written:
+                for earlier in reversed(self.checkpoints[:index + 1]):
+                    if page in earlier.pages[name]:
+                        contents = earlier.pages[name][page]
+                        image[page * size:page * size + len(contents)] = contents
+                        break
+            memory.clear_dirty()
+
+        snapshot.apply_state(checkpoint.state, self.cpus, self.devices)
+        # Pages written from here on belong to the next checkpoint taken.
+        del self.checkpoints[index + 1:]
+        self._generation += 1
+        self._arm(checkpoint.icount + self.interval)
+
+    def _replay(self, icount):
+        '''
+            Executes up to icount with the debugger out of the way, injecting the logged
+            interrupts on the way.
+        '''
+        cpu = self.cpu
+        context = cpu.context
+        pending = [entry for entry in self.interrupts if cpu.icount <= entry[0]]
+        for at, irq in pending:
+            if at < icount:
+                cpu.schedule(at, lambda cpu, irq=irq: cpu.interrupt_triggered(irq))
+        # Idle fast-forwarding under virtual time stops there too.
+        cpu.schedule(icount, lambda cpu: None)
+
+        stepping, ops, ips = context.STEPPING, context.GDB_ops, context.GDB_IPs
+        context.STEPPING, context.GDB_ops, context.GDB_IPs = False, [], []
+        self._replaying = True
+        try:
+            while cpu.icount < icount:
+                cpu.execute()
+            # Asserted right before the instruction we stop at.
+            for at, irq in pending:
+                if at == icount:
+                    cpu.interrupt_triggered(irq)
+        finally:
+            self._replaying = False
+            context.STEPPING, context.GDB_ops, context.GDB_IPs = stepping, ops, ips
+
+    def goto(self, icount):
+        '''
+            Brings the machine back to icount, or to the oldest checkpoint if icount is older.
+            Only call it from the cpu thread between two instructions, e.g. from cpu.post.
+        '''
+        icount = max(icount, self.oldest())
+        self._restore(self._nearest(icount))
+        self._replay(icount)
+        self.interrupts = [entry for entry in self.interrupts if entry[0] <= icount]
+        held, self._held = self._held, []
+        for irq in held:
+            self._interrupt_triggered(irq)
+        return icount
+
+    def last_breakpoint(self, before):
+        '''
+            The last instruction count below before at which a gdb breakpoint was fetched,
+            searching one checkpoint interval at a time backwards. None if there is none.
+        '''
+        context = self.cpu.context
+        ips, ops = list(context.GDB_IPs), list(context.GDB_ops)
+        hits = []
+        def hit(cpu, pc, op):
+            if pc in ips or op in ops:
+                hits.append(cpu.icount)
+
+        end = before
+        index = self._nearest(before - 1)
+        while index >= 0:
+            self._restore(index)
+            self.cpu.register_plugin('insn', hit)
+            try:
+                self._replay(end)
+            finally:
+                self.cpu.unregister_plugin('insn', hit)
+            hits = [icount for icount in hits if icount < before]
+            if hits:
+                return hits[-1]
+            end = self.checkpoints[index].icount
+            index -= 1
+        return None
+
+    def reverse_step(self):
+        '''
+            From the gdb stub while the cpu is stopped: resumes it so it goes back one
+            instruction and stops again.
+        '''
+        target = self.cpu.icount - 1
+        self._resume(lambda cpu: self.goto(target))
+
+    def reverse_continue(self):
+        '''
+            Like reverse_step, back to the previous breakpoint or the oldest checkpoint.
+        '''
+        before = self.cpu.icount
+        def back(cpu):
+            target = self.last_breakpoint(before)
+            if target is None:
+                self.logger.warning("No breakpoint since instruction (%s)", self.oldest())
+                target = self.oldest()
+            self.goto(target)
+        self._resume(back)
+
+    def _resume(self, rewind):
+        # The cpu finishes the instruction it stopped at before it gets to the posted rewind,
+        # then stops right after it.
+        def rewind_and_stop(cpu):
+            rewind(cpu)
+            cpu.context.STEPPING = True
+        self.cpu.post(rewind_and_stop)
+        self.cpu.context.dbg_event.set()
@@ -0,0 +1,61 @@
+'''
+    Per-machine state.
+
+    A MachineContext holds what the soc, its cpus, its buses and its debugger share: the
+    debugger events and breakpoints, the main cpu, the stoppable components. global_env.context
+    is the one of everything created without one, several machines built with their own
+    contexts can run in one process without seeing each other.
+
+    The tracer in instrumentation.trace is still one per process.
+'''
+from threading import Event
+
+class ComponentNotRegistered(Exception):
+    def __init__(self, name):
+        Exception.__init__(self)
+        self.component_name = name
+
+class MachineContext(object):
+    def __init__(self):
+        self.ENV = {}
+
+        self.dbg_breakpoint_hit = False
+        self.dbg_event = Event()
+        self.dbg_event.set() # single-instruction stepping is OFF by default
+
+        self.STEPPING = False
+        self.GDB_ops = []
+        self.GDB_IPs = []
+
+        self.main_cpu = None
+
+        # Stoppable components
+        self.soc = None
+        self.dbg = None
+        self.char_devices = []
+        # Called by stop_all, e.g. to write out profiles.
+        self.stop_callbacks = []
+        # A soc.checkpoints.CheckpointRing, lets the gdb stub execute backwards.
+        self.checkpoints = None
+
+    def get_component(self, name):
+        try:
+            return self.ENV[name]
+        except KeyError:
+            raise ComponentNotRegistered(name)
+
+    def stop_all(self):
+        if self.soc:
+            self.soc.stop()
+
+        if self.dbg:
+            self.dbg.stop()
+
+        for char_device in self.char_devices:
+            char_device.stop()
+
+        for callback in self.stop_callbacks:
+            callback()
+
+    def get_info(self):
+        return self.soc.get_info()
@@ -1,11 +1,12 @@
 from controllers.interfaces import AbstractBankedAddressableObject
 from host_frontends.binary_freader import BinaryFileReader
 from controllers.memory import SimpleROM, SimpleMemory
+from controllers.timer import SimpleTimer
 from processors.arm.cortext_a9 import ARMCortexA9
 from utils.string import convert_to_string
 from buses.simple_bus import SimpleBus
 from soc.omap4 import memory_map
-from ctypes import c_uint32
+from soc import snapshot
 
 import threading
 import global_env
@@ -20,21 +21,56 @@ TINYOS_PATH     = None
 class OMAP4(threading.Thread):
     CHItems = ['CHSETTINGS', 'CHRAM', 'CHFLASH', 'CHMMCSD']
     
-    def __init__(self):
+    def __init__(self, snapshot_path=None, lazy_restore=True, context=None, os_path=None):
         threading.Thread.__init__(self)
+        # A soc.context.MachineContext shared with our cpu, bus and debugger.
+        self.context = context if context is not None else global_env.context
+        self.context.soc = self
+        # The OS image, TINYOS_PATH when not given.
+        self.os_path = os_path
+        # Restore this snapshot instead of loading the images.
+        self.snapshot_path = snapshot_path
+        self.lazy_restore = lazy_restore
+        # Set by prepare().
+        self.mpu = None
+        # A soc.page_store.PageStore, snapshots are then names in the store instead of directories.
+        self.snapshot_store = None
+        # A host_frontends.replay event log, attached to cpu0 once the machine is prepared.
+        self.event_log = None
 
     def boot(self):
         self.start()
         
     def run(self):
+        # Prepared beforehand when instrumentation has to see cpu0 from its first instruction.
+        if self.mpu is None:
+            self.prepare()
+        self.mpu.run()
+    
+    def prepare(self):
+        '''
+            Builds the machine and loads it, or restores it from snapshot_path, without
+            running it.
+        '''
+        self.build()
+        if self.snapshot_path:
+            self.restore_snapshot(self.snapshot_path, self.lazy_restore)
+        else:
+            self.load()
+        if self.event_log is not None:
+            self.event_log.attach(self.mpu.cpu0)
+            for device in self.devices().values():
+                if isinstance(device, SimpleTimer):
+                    self.event_log.timer(device)
+    
+    def build(self):
+        '''
+            Creates the devices and wires the buses, nothing is loaded yet.
+        '''
         # Create a nand device "nand"
         self.sys_bus = SimpleBus('system bus')
         
         self.rom = SimpleROM("cortex-a9 mpu rom", 48, False)
-        rom_file = BinaryFileReader(ROM_PATH)
-        rom_file.readin(self.rom._init_write, 48 * 1024)
-        rom_file.close()
-        
         self.l3_ocm_ram = SimpleMemory("l3 ocm ram", 56, False)
         self.dmm_registers = SimpleMemory("dmm registers", 32 * 1024, False)
         self.emif1_registers = SimpleMemory("emif1 registers", 16 * 1024, False)
@@ -59,23 +95,69 @@ class OMAP4(threading.Thread):
         #l4_cfg domain
         self.sys_bus.attach_slave(self.l4_cfg_domain, memory_map.L4_CFG_DOMAIN_START, memory_map.L4_CFG_DOMAIN_END)
         
-        self.mpu = CORTEXA9MPU('OMAP4 cortex-a9 mpu', self.sys_bus)
+        self.mpu = CORTEXA9MPU('OMAP4 cortex-a9 mpu', self.sys_bus, self.context, self.os_path or TINYOS_PATH)
+    
+    def load(self):
+        '''
+            Loads the rom and the boot images, cpu0 is left at the OS entry.
+        '''
+        rom_file = BinaryFileReader(ROM_PATH)
+        rom_file.readin(self.rom._init_write, 48 * 1024)
+        rom_file.close()
         
-        # Now start it.
-        self.mpu.boot()
+        self.mpu.load()
     
     def stop(self):
         self.mpu.stop()
+    
+    def memories(self):
+        return {
+                'rom'               : self.rom,
+                'l3_ocm_ram'        : self.l3_ocm_ram,
+                'dmm_registers'     : self.dmm_registers,
+                'emif1_registers'   : self.emif1_registers,
+                'emif2_registers'   : self.emif2_registers,
+                'l4_cfg_domain'     : self.l4_cfg_domain
+               }
+    
+    def cpus(self):
+        return {'cpu0': self.mpu.cpu0}
+    
+    def devices(self):
+        # No timer or interrupt controller is wired in yet.
+        return {}
+    
+    def save_snapshot(self, path):
+        '''
+            Only consistent while cpu0 isn't executing, e.g. from a cpu0.schedule() event.
+        '''
+        if self.snapshot_store is not None:
+            self.snapshot_store.save(path, self.cpus(), self.memories(), self.devices())
+        else:
+            snapshot.save(path, self.cpus(), self.memories(), self.devices())
+    
+    def restore_snapshot(self, path, lazy=False):
+        if self.snapshot_store is not None:
+            # Stored pages are compressed, nothing to map.
+            self.snapshot_store.restore(path, self.cpus(), self.memories(), self.devices())
+        else:
+            snapshot.restore(path, self.cpus(), self.memories(), self.devices(), lazy)
         
     def get_info(self):
         return self.mpu.get_info()
 
 class CORTEXA9MPU(object):
-    def __init__(self, name, bus):
-        global_env.main_cpu = self.cpu0 = ARMCortexA9('arm cortex a9', bus)
+    def __init__(self, name, bus, context=None, os_path=None):
+        context = context if context is not None else global_env.context
+        context.main_cpu = self.cpu0 = ARMCortexA9('arm cortex a9', bus, context=context)
         self.bus = bus
+        self.os_path = os_path
         
     def boot(self):
+        self.load()
+        self.run()
+    
+    def load(self):
 #        nand_device = self.get_component("nand")
 #        next = 0
 #        data = nand_device.read(next, 512)
@@ -106,25 +188,29 @@ class CORTEXA9MPU(object):
 #        self.cpu0.set_ip(dst)
 
         ram_vecs_file = BinaryFileReader(RAM_VECS_PATH)
-        ram_vecs_file.readin(self.bus.write, 56, memory_map.L3_OCM_RAM_EXCEPTIONS_VECTOR)
+        # Load the images as seen by cpu0.
+        port = self.cpu0.bus_port
+        ram_vecs_file.readin(port.write, 56, memory_map.L3_OCM_RAM_EXCEPTIONS_VECTOR)
         ram_vecs_file.close()
         
-        temp_os_file = BinaryFileReader(TINYOS_PATH)
+        temp_os_file = BinaryFileReader(self.os_path)
         os_size = temp_os_file.getsize()
         boot_struct_address = memory_map.L3_OCM_RAM_START + os_size
-        temp_os_file.readin(self.bus.write, temp_os_file.getsize(), memory_map.L3_OCM_RAM_START)
+        temp_os_file.readin(port.write, temp_os_file.getsize(), memory_map.L3_OCM_RAM_START)
         
         boot_parameters = []
-        boot_parameters.append(c_uint32(0))
-        boot_parameters.append(c_uint32(0))
-        boot_parameters.append(c_uint32(0x3 | (0 << 8) | (0 << 16)))
+        boot_parameters.append(0)
+        boot_parameters.append(0)
+        boot_parameters.append(0x3 | (0 << 8) | (0 << 16))
         
         for index in range(3):
-            self.bus.write(boot_struct_address + (index<<2), boot_parameters[index])
+            port.write(boot_struct_address + (index<<2), boot_parameters[index])
             
         
-        self.cpu0.register_write(0, c_uint32(boot_struct_address))
-        self.cpu0.set_ip(c_uint32(memory_map.L3_OCM_RAM_START))
+        self.cpu0.register_write(0, boot_struct_address)
+        self.cpu0.set_ip(memory_map.L3_OCM_RAM_START)
+    
+    def run(self):
         self.cpu0.run()
     
     def stop(self):
@@ -0,0 +1,162 @@
+'''
+    Content addressed snapshot store.
+
+    Memories are cut into fixed-size pages, every page is stored once under the sha1 of its
+    contents and snapshots only list the page hashes of each memory:
+
+        root/pages/3f/786850e387550fdab836ed7e6dc881de23001b
+        root/snapshots/<name>.json
+
+    Saving a snapshot that differs from the stored ones in a few pages only writes those
+    pages. Once a memory was saved or restored through the store, the next save only hashes
+    the pages its dirty tracking reports as written since. Pages can be compressed with zlib or, when an lzma module is importable, lzma.
+'''
+import os
+import json
+import zlib
+import hashlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+from soc import snapshot
+
+PAGE_SIZE = 4096
+
+# First byte of a stored page, how the rest is encoded.
+CODEC_RAW   = 'r'
+CODEC_ZLIB  = 'z'
+CODEC_LZMA  = 'x'
+
+COMPRESSIONS = {
+                None    : CODEC_RAW,
+                'zlib'  : CODEC_ZLIB,
+                'lzma'  : CODEC_LZMA
+               }
+
+class UnsupportedCompression(Exception):
+    def __init__(self, compression):
+        Exception.__init__(self)
+        self.compression = compression
+
+class PageStore(object):
+    def __init__(self, root, compression='zlib', page_size=PAGE_SIZE):
+        if compression not in COMPRESSIONS or (compression == 'lzma' and lzma is None):
+            raise UnsupportedCompression(compression)
+        
+        self.root = root
+        self.codec = COMPRESSIONS[compression]
+        self.page_size = page_size
+        # Digests known to be stored already.
+        self._known = set()
+        # memory name => (memory, page digests) as of the last save or restore.
+        self._baselines = {}
+        for directory in ('pages', 'snapshots'):
+            if not os.path.isdir(os.path.join(root, directory)):
+                os.makedirs(os.path.join(root, directory))
+    
+    def _page_path(self, digest):
+        return os.path.join(self.root, 'pages', digest[:2], digest[2:])
+    
+    def _encode(self, data):
+        if self.codec == CODEC_ZLIB:
+            return CODEC_ZLIB + zlib.compress(data)
+        if self.codec == CODEC_LZMA:
+            return CODEC_LZMA + lzma.compress(data)
+        return CODEC_RAW + data
+    
+    def _decode(self, blob):
+        codec, data = blob[0], blob[1:]
+        if codec == CODEC_ZLIB:
+            return zlib.decompress(data)
+        if codec == CODEC_LZMA:
+            if lzma is None:
+                raise UnsupportedCompression('lzma')
+            return lzma.decompress(data)
+        return data
+    
+    def put_page(self, data):
+        '''
+            Stores data unless a page with the same contents already is, returns its digest.
+        '''
+        digest = hashlib.sha1(data).hexdigest()
+        if digest in self._known:
+            return digest
+        
+        path = self._page_path(digest)
+        if not os.path.exists(path):
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            # Written aside and renamed so a crash never leaves a truncated page behind.
+            with open(path + '.tmp', 'wb') as page:
+                page.write(self._encode(data))
+            os.rename(path + '.tmp', path)
+        self._known.add(digest)
+        return digest
+    
+    def get_page(self, digest):
+        with open(self._page_path(digest), 'rb') as page:
+            return self._decode(page.read())
+    
+    def _snapshot_path(self, name):
+        return os.path.join(self.root, 'snapshots', name + '.json')
+    
+    def snapshots(self):
+        return sorted(entry[:-5] for entry in os.listdir(os.path.join(self.root, 'snapshots')) if entry.endswith('.json'))
+    
+    def save(self, name, cpus, memories, devices={}):
+        header = snapshot.capture_state(cpus, devices)
+        for memory_name, memory in memories.items():
+            image = memory.image()
+            baseline = self._baselines.get(memory_name)
+            if baseline is not None and baseline[0] is memory and memory.page_size() == self.page_size:
+                pages = list(baseline[1])
+                for page in memory.dirty_pages():
+                    offset = page * self.page_size
+                    pages[page] = self.put_page(bytes(image[offset:offset + self.page_size]))
+            else:
+                pages = []
+                for offset in range(0, len(image), self.page_size):
+                    pages.append(self.put_page(bytes(image[offset:offset + self.page_size])))
+            
+            memory.clear_dirty()
+            self._baselines[memory_name] = (memory, pages)
+            header['memories'][memory_name] = {'size': len(image), 'page_size': self.page_size, 'pages': pages}
+        
+        with open(self._snapshot_path(name), 'w') as header_file:
+            json.dump(header, header_file, sort_keys=True)
+    
+    def restore(self, name, cpus, memories, devices={}):
+        with open(self._snapshot_path(name)) as header_file:
+            header = json.load(header_file)
+        snapshot.check_version(name, header)
+        
+        # Decoded pages by digest, zero filled ones are repeated all over.
+        pages = {}
+        for memory_name, memory in memories.items():
+            try:
+                entry = header['memories'][memory_name]
+            except KeyError:
+                raise snapshot.SnapshotMismatch(memory_name, "memory missing from the snapshot")
+            
+            image = memory.image()
+            if entry['size'] != len(image):
+                raise snapshot.SnapshotMismatch(memory_name, "size %s, expected %s" % (entry['size'], len(image)))
+            
+            page_size = entry['page_size']
+            for index, digest in enumerate(entry['pages']):
+                data = pages.get(digest)
+                if data is None:
+                    data = pages[digest] = self.get_page(digest)
+                image[index * page_size:index * page_size + len(data)] = data
+            
+            memory.clear_dirty()
+            if page_size == self.page_size:
+                self._baselines[memory_name] = (memory, list(entry['pages']))
+        
+        snapshot.apply_state(header, cpus, devices)
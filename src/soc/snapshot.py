@@ -0,0 +1,102 @@
+'''
+    Machine snapshots.
+
+    A snapshot is a directory with a small machine.json header (cpu states, device states and
+    the memory layout) and one raw image per memory, <name>.bin, byte for byte the memory
+    backing store so it can be mapped as is:
+
+        machine.json
+        l3_ocm_ram.bin
+        ...
+
+    cpus, memories and devices are {name: object} dicts, devices have get_state/set_state.
+'''
+import io
+import os
+import json
+
+SNAPSHOT_VERSION = 1
+HEADER = 'machine.json'
+
+class SnapshotMismatch(Exception):
+    def __init__(self, name, reason):
+        Exception.__init__(self)
+        self.name = name
+        self.reason = reason
+
+def capture_state(cpus, devices):
+    '''
+        The header of a snapshot without the memories.
+    '''
+    return {
+            'version'   : SNAPSHOT_VERSION,
+            'cpus'      : dict((name, cpu.get_state()) for name, cpu in cpus.items()),
+            'devices'   : dict((name, device.get_state()) for name, device in devices.items()),
+            'memories'  : {}
+           }
+
+def apply_state(header, cpus, devices):
+    for name, cpu in cpus.items():
+        cpu.set_state(header['cpus'][name])
+    
+    for name, device in devices.items():
+        device.set_state(header['devices'][name])
+
+def check_version(path, header):
+    if header['version'] != SNAPSHOT_VERSION:
+        raise SnapshotMismatch(path, "version %s" % header['version'])
+
+def save(path, cpus, memories, devices={}):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    
+    header = capture_state(cpus, devices)
+    
+    for name, memory in memories.items():
+        image = memory.image()
+        blob_path = os.path.join(path, name + '.bin')
+        # Written aside and renamed, a memory restored lazily from this very snapshot is
+        # mapped from the old blob and keeps its inode instead of seeing it truncated.
+        with open(blob_path + '.tmp', 'wb') as blob:
+            blob.write(image)
+        os.rename(blob_path + '.tmp', blob_path)
+        header['memories'][name] = {'file': name + '.bin', 'size': len(image)}
+    
+    # The header goes last, a snapshot without one is incomplete.
+    with open(os.path.join(path, HEADER), 'w') as header_file:
+        json.dump(header, header_file, indent=4, sort_keys=True)
+
+def load_header(path):
+    with open(os.path.join(path, HEADER)) as header_file:
+        header = json.load(header_file)
+    
+    check_version(path, header)
+    return header
+
+def restore(path, cpus, memories, devices={}, lazy=False):
+    '''
+        With lazy the memories map their images copy-on-write instead of reading them, the
+        cost of a restore is then the pages the guest touches afterwards.
+    '''
+    header = load_header(path)
+    
+    for name, memory in memories.items():
+        try:
+            entry = header['memories'][name]
+        except KeyError:
+            raise SnapshotMismatch(name, "memory missing from the snapshot")
+        
+        image = memory.image()
+        if entry['size'] != len(image):
+            raise SnapshotMismatch(name, "size %s, expected %s" % (entry['size'], len(image)))
+        # The restored image is the new reference for dirty tracking.
+        memory.clear_dirty()
+        if lazy:
+            memory.map_image(os.path.join(path, entry['file']))
+            continue
+        
+        # One sequential read straight into the backing store.
+        with io.open(os.path.join(path, entry['file']), 'rb') as blob:
+            blob.readinto(image)
+    
+    apply_state(header, cpus, devices)
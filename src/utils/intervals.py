@@ -0,0 +1,57 @@
+import bisect
+
+class IntervalIndex(object):
+    '''
+        Sorted set of non-overlapping half-open [start, end) intervals.
+        Every entry is a tuple whose first two items are (start, end), the rest is free for the caller.
+    '''
+    def __init__(self):
+        self._starts = []
+        self._entries = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def find(self, address):
+        index = bisect.bisect_right(self._starts, address) - 1
+        if index >= 0:
+            entry = self._entries[index]
+            if address < entry[1]:
+                return entry
+        return None
+
+    def find_overlap(self, start, end):
+        index = bisect.bisect_left(self._starts, end) - 1
+        if index >= 0:
+            entry = self._entries[index]
+            if entry[1] > start and end > start:
+                return entry
+        return None
+
+    def uncovered(self, start, end):
+        '''
+            Returns the sub-ranges of [start, end) that no entry covers.
+        '''
+        gaps = []
+        cursor = start
+        index = max(bisect.bisect_right(self._starts, start) - 1, 0)
+        for entry in self._entries[index:]:
+            if entry[0] >= end:
+                break
+            if entry[1] <= cursor:
+                continue
+            if entry[0] > cursor:
+                gaps.append((cursor, entry[0]))
+            cursor = max(cursor, entry[1])
+        
+        if cursor < end:
+            gaps.append((cursor, end))
+        return gaps
+
+    def insert(self, entry):
+        index = bisect.bisect_right(self._starts, entry[0])
+        self._starts.insert(index, entry[0])
+        self._entries.insert(index, entry)